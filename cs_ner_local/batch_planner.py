@@ -0,0 +1,74 @@
+from itertools import islice
+from typing import List, Dict, Any, Iterable, Iterator
+
+from utils import count_tokens_many
+
+# 배치 구성 기본값
+MIN_BATCH_ITEMS = 1
+MAX_BATCH_ITEMS = 20
+TARGET_BATCH_INPUT_TOKENS = 4000  # 배치당 문의 본문 토큰 목표치 (시스템 프롬프트 제외)
+EXPECTED_OUTPUT_TOKENS_PER_ITEM = 60  # 항목당 응답 JSON 예상 토큰 수
+MAX_OUTPUT_TOKENS = 1024  # API 호출 시 max_tokens
+OUTPUT_BUDGET_RATIO = 0.75  # 항목 수는 max_tokens 의 이 비율까지만 채운다 (예상보다 긴 응답에 대한 여유분)
+ITEM_OVERHEAD_TOKENS = 20  # 항목별 id, 필드명, 따옴표 등 고정 오버헤드
+PLANNING_CHUNK_SIZE = 1000  # 토큰 수를 한 번에 계산할 항목 수
+
+# user message 에 실제로 들어가는 필드 (title_anon 등은 전송되지 않음)
+PROMPT_FIELDS = ("content", "pre_level1", "pre_level2", "pre_level3")
+
+
+def estimate_items_tokens(items: List[Dict[str, Any]]) -> List[int]:
+    """user message 안에서 각 항목이 차지하는 토큰 수 추정 (count_tokens_many 로 일괄 계산)"""
+    texts = []
+    owners = []
+    for idx, item in enumerate(items):
+        for key in PROMPT_FIELDS:
+            value = item.get(key)
+            if value is not None and value != "":
+                texts.append(str(value))
+                owners.append(idx)
+
+    item_tokens = [ITEM_OVERHEAD_TOKENS] * len(items)
+    for owner, tokens in zip(owners, count_tokens_many(texts)):
+        item_tokens[owner] += tokens
+    return item_tokens
+
+
+def plan_batches(
+    items: Iterable[Dict[str, Any]],
+    min_items: int = MIN_BATCH_ITEMS,
+    max_items: int = MAX_BATCH_ITEMS,
+    target_input_tokens: int = TARGET_BATCH_INPUT_TOKENS,
+    max_output_tokens: int = MAX_OUTPUT_TOKENS,
+    output_tokens_per_item: int = EXPECTED_OUTPUT_TOKENS_PER_ITEM,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    입력 토큰 예산과 출력 토큰 예산을 넘지 않도록 항목들을 순서대로 배치에 채운다.
+    - 짧은 문의는 한 배치에 많이, 긴 문의는 적게 담긴다.
+    - 출력 예산(max_output_tokens * OUTPUT_BUDGET_RATIO)은 응답 잘림을 막기 위한 상한이므로 min_items 보다 우선한다.
+    - 입력 예산은 min_items 를 채운 뒤부터 적용된다.
+    """
+    max_items_by_output = max(1, int(max_output_tokens * OUTPUT_BUDGET_RATIO) // output_tokens_per_item)
+    max_items = max(1, min(max_items, max_items_by_output))
+    min_items = max(1, min(min_items, max_items))
+
+    current: List[Dict[str, Any]] = []
+    current_tokens = 0
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, PLANNING_CHUNK_SIZE))
+        if not chunk:
+            break
+        for item, item_tokens in zip(chunk, estimate_items_tokens(chunk)):
+            if current and (
+                len(current) >= max_items
+                or (len(current) >= min_items and current_tokens + item_tokens > target_input_tokens)
+            ):
+                yield current
+                current = []
+                current_tokens = 0
+            current.append(item)
+            current_tokens += item_tokens
+
+    if current:
+        yield current
@@ -0,0 +1,63 @@
+import json
+from typing import List, Dict, Any, Optional
+
+# 프롬프트에 들어가는 카테고리 필드 순서 (고정)
+CATEGORY_FIELDS = ("level1", "level2", "level3", "description", "note")
+LEVEL_FIELDS = ("level1", "level2", "level3")
+CATEGORY_ID_PREFIX = "C"
+
+
+def _category_sort_key(category: Dict[str, Any]):
+    return tuple(str(category.get(key, "")) for key in CATEGORY_FIELDS)
+
+
+class CategoryCodec:
+    """
+    카테고리 테이블을 시스템 프롬프트용으로 압축하고, 모델 응답을 전체 level 명칭으로 복원한다.
+
+    - 행마다 반복되던 level1/level2 문자열을 level1 → level2 → level3 트리로 묶는다.
+    - description/note 는 값이 있을 때만 포함한다.
+    - use_ids=True 면 level3 마다 짧은 ID(C1, C2, ...)를 붙이고, 모델은 category_id 만 응답한다.
+    - Provider 측 prompt caching 이 적중하도록 실행마다 바이트 단위로 동일한 문자열을 만든다
+      (정렬된 행 순서, 고정 필드 순서, 고정 구분자).
+    """
+
+    def __init__(self, categories: List[Dict[str, Any]], use_ids: bool = False):
+        self.use_ids = use_ids
+        self.tree: Dict[str, Dict[str, Dict[str, Dict[str, str]]]] = {}
+        self.levels_by_id: Dict[str, Dict[str, str]] = {}
+
+        for category in sorted(categories, key=_category_sort_key):
+            level1, level2, level3 = (str(category.get(key, "")) for key in LEVEL_FIELDS)
+            leaf = self.tree.setdefault(level1, {}).setdefault(level2, {}).get(level3)
+            if leaf is None:
+                leaf = {}
+                if use_ids:
+                    category_id = f"{CATEGORY_ID_PREFIX}{len(self.levels_by_id) + 1}"
+                    leaf["id"] = category_id
+                    self.levels_by_id[category_id] = {"level1": level1, "level2": level2, "level3": level3}
+                self.tree[level1][level2][level3] = leaf
+
+            # 같은 level1~3 조합이 여러 행에 있으면 description/note 를 이어 붙인다
+            for key in ("description", "note"):
+                value = str(category.get(key, "")).strip()
+                if value and value not in leaf.get(key, "").split(" / "):
+                    leaf[key] = f"{leaf[key]} / {value}" if leaf.get(key) else value
+
+    def to_prompt_json(self) -> str:
+        """시스템 프롬프트의 AVAILABLE_CATEGORIES 에 들어갈 JSON"""
+        return json.dumps(self.tree, ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        모델 응답 항목의 category_id 를 level1~3 명칭으로 복원 (ID 모드가 아니면 그대로 반환).
+        테이블에 없는 category_id 면 None.
+        """
+        if not self.use_ids:
+            return item
+        levels = self.levels_by_id.get(str(item.get("category_id", "")).strip())
+        if levels is None:
+            return None
+        decoded = {key: value for key, value in item.items() if key != "category_id"}
+        decoded.update(levels)
+        return decoded
@@ -2,23 +2,52 @@
 import os
 import json
 import pandas as pd
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Callable, List, Dict, Any, Union, Optional
 
-from preprocessing import preprocess_air, preprocess_simple
+from preprocessing import preprocess_air, preprocess_simple, AIR_MASK_COLS
+from categories import CategoryCodec
 
 @dataclass
 class DomainConfig:
     domain_name: str
+    # API 요청/응답 항목의 식별자 컬럼 (결과 병합 키)
+    id_column: str
     # input_columns can be Dict (mapping) or List (positional rename)
     input_columns: Union[Dict[str, str], List[str]] 
     system_prompt_template: str
-    user_message_creator: Callable[[List[Dict[str, Any]]], str]
+    # (batch_items, use_category_ids=False) -> user message
+    user_message_creator: Callable[..., str]
     preprocess_func: Callable[[pd.DataFrame], pd.DataFrame]
+    # API 처리(마스킹/집계/요청)에 필요한 컬럼만 읽는다 (None 이면 전체)
+    api_columns: Optional[List[str]] = None
+    # 결과 파일에 함께 저장할 원본 컬럼 (None 이면 전체). API 처리가 끝난 뒤 파일에서 다시 읽어 병합한다
+    passthrough_columns: Optional[List[str]] = None
+    # --slim-output 시 결과 파일에 남길 원본 컬럼 (식별자 위주)
+    slim_columns: Optional[List[str]] = None
+    # 파일을 읽을 때 적용할 컬럼별 dtype (CATEGORY_DTYPE: 값 종류가 적은 컬럼, TEXT_DTYPE: 자유 텍스트)
+    dtype_plan: Dict[str, str] = field(default_factory=dict)
+
+    def output_columns(self) -> Optional[List[str]]:
+        """결과 병합 시 원본에서 읽을 컬럼 (병합 키 포함)"""
+        if self.passthrough_columns is None:
+            return None
+        return [self.id_column] + [c for c in self.passthrough_columns if c != self.id_column]
+
+# dtype_plan 값
+CATEGORY_DTYPE = "category"
+TEXT_DTYPE = "text"  # pyarrow 가 있으면 string[pyarrow], 없으면 변환하지 않음
+
+# 프롬프트/응답 스키마 로직을 바꾸면 올린다 (결과 캐시 키에 포함되어 이전 결과가 재사용되지 않음)
+PROMPT_VERSION = "1"
 
 # --- Air Domain Logic ---
 
-def create_user_message_air(batch_items: List[Dict[str, Any]]) -> str:
+AIR_RESPONSE_SCHEMA = '[{"thread_id":"...","level1":"...","level2":"...","level3":"..."}, …]'
+AIR_RESPONSE_SCHEMA_WITH_IDS = '[{"thread_id":"...","category_id":"..."}, …]'
+
+def create_user_message_air(batch_items: List[Dict[str, Any]], use_category_ids: bool = False) -> str:
+    response_schema = AIR_RESPONSE_SCHEMA_WITH_IDS if use_category_ids else AIR_RESPONSE_SCHEMA
     lines = []
     for idx, itm in enumerate(batch_items, 1):
         content_esc = str(itm.get("content", "")).replace('"', '\\"')
@@ -33,7 +62,7 @@ def create_user_message_air(batch_items: List[Dict[str, Any]]) -> str:
         f"1. 입력된 문의만 분류하세요. 추가 문의를 만들지 마세요.\n"
         f"2. 응답은 반드시 아래 스키마에 맞춰주세요.\n"
         f"3. 응답은 정확히 {len(batch_items)}개 항목을 포함해야 합니다.\n\n"
-        f"RESPONSE_SCHEMA:\n[{{\"thread_id\":\"...\",\"level1\":\"...\",\"level2\":\"...\",\"level3\":\"...\"}}, …]"
+        f"RESPONSE_SCHEMA:\n{response_schema}"
     )
 
 AIR_SYSTEM_PROMPT = (
@@ -49,12 +78,18 @@ AIR_SYSTEM_PROMPT = (
     "7. level1의 명칭이 level2 또는 level3로 사용되지 않도록 하며, 분류 체계의 상하 관계를 유지하세요.\n"
     "8. 분류는 반드시 AVAILABLE_CATEGORIES에 명시된 level1~3 조합 중에서만 선택해야 합니다.\n"
     "9. 적절한 조합이 없다고 판단될 경우, 가장 가까운 의미의 조합을 선택하고 새 항목은 절대 생성하지 마세요.\n"
+    "{category_guide}"
     "AVAILABLE_CATEGORIES = {categories_json}"
 )
 
 # --- Package / Air 2 Domain Logic ---
 
-def create_user_message_simple(batch_items: List[Dict[str, Any]]) -> str:
+SIMPLE_RESPONSE_SCHEMA = '[{"ticket_id":"...","level1":"...","level2":"...","level3":"..."}]'
+SIMPLE_RESPONSE_SCHEMA_WITH_IDS = '[{"ticket_id":"...","category_id":"..."}]'
+
+def create_user_message_simple(batch_items: List[Dict[str, Any]], use_category_ids: bool = False) -> str:
+    response_schema = SIMPLE_RESPONSE_SCHEMA_WITH_IDS if use_category_ids else SIMPLE_RESPONSE_SCHEMA
+
     def norm(x: Any) -> str:
         return "" if x is None else str(x)
 
@@ -83,7 +118,7 @@ def create_user_message_simple(batch_items: List[Dict[str, Any]]) -> str:
           "2) level1~3은 반드시 AVAILABLE_CATEGORIES 중 하나의 조합이어야 합니다. 새 항목을 만들지 마세요.\n"
           "3) 반환 스키마는 아래와 같고, 추가 필드를 만들지 마세요.\n\n"
           "RESPONSE_SCHEMA:\n"
-          '[{"ticket_id":"...","level1":"...","level2":"...","level3":"..."}]'
+        + response_schema
     )
 
 SIMPLE_SYSTEM_PROMPT = (
@@ -102,9 +137,28 @@ SIMPLE_SYSTEM_PROMPT = (
     "7. level1의 명칭이 level2 또는 level3로 사용되지 않도록 하며, 분류 체계의 상하 관계를 유지하세요.\n"
     "8. 분류는 반드시 AVAILABLE_CATEGORIES에 명시된 level1~3 조합 중에서만 선택해야 합니다.\n"
     "9. 적절한 조합이 없다고 판단될 경우, 가장 가까운 의미의 조합을 선택하고 새 항목은 절대 생성하지 마세요.\n"
+    "{category_guide}"
     "AVAILABLE_CATEGORIES = {categories_json}"
 )
 
+# --- Category Table Guide ---
+
+CATEGORY_TREE_GUIDE = (
+    "AVAILABLE_CATEGORIES는 {level1: {level2: {level3: {description, note}}}} 형태의 트리이며, "
+    "값이 없는 description/note는 생략되어 있습니다.\n"
+)
+
+CATEGORY_ID_GUIDE = (
+    "각 level3에는 id가 있습니다. 응답에는 level1~3 명칭 대신 선택한 level3의 id를 category_id로 반환하세요.\n"
+)
+
+def build_system_prompt(config: DomainConfig, category_codec: CategoryCodec) -> str:
+    guide = CATEGORY_TREE_GUIDE + (CATEGORY_ID_GUIDE if category_codec.use_ids else "")
+    return config.system_prompt_template.format(
+        category_guide=guide,
+        categories_json=category_codec.to_prompt_json(),
+    )
+
 # --- Configuration Map ---
 
 # Column Definitions from 1_renewal... scripts
@@ -132,27 +186,64 @@ PACKAGE_COLS = [
     "department", "agent_name", "manager_name"
 ] # Assuming same as Air2 based on 14 column check usually
 
+# API 처리에 쓰이는 컬럼 (나머지는 결과 저장 시 원본에서 다시 읽음)
+AIR_API_COLS = [
+    "thread_id", "inquiry_created_at", "inquiry_title", "inquiry_content", "response_type"
+] + AIR_MASK_COLS
+
+SIMPLE_API_COLS = ["ticket_id", "content", "pre_level1", "pre_level2", "pre_level3"]
+
+# 반복 값이 많은 컬럼은 category, 자유 텍스트는 Arrow 문자열로 읽어 메모리 절감
+AIR_DTYPE_PLAN = {
+    **{col: CATEGORY_DTYPE for col in [
+        "inquiry_type_code", "parent_type", "inquiry_type", "inquiry_type_name",
+        "response_type", "inquiry_status", "destination",
+    ]},
+    **{col: TEXT_DTYPE for col in ["inquiry_title", "inquiry_content", "product_info"]},
+}
+
+SIMPLE_DTYPE_PLAN = {
+    **{col: CATEGORY_DTYPE for col in [
+        "channel", "call_type", "customer_type", "inquiry_type",
+        "main_category", "sub_category", "detail_category",
+        "department", "agent_name", "manager_name",
+    ]},
+    "content": TEXT_DTYPE,
+}
+
 CONFIGS = {
     "air": DomainConfig(
         domain_name="air",
+        id_column="thread_id",
         input_columns=AIR_COLS,
         system_prompt_template=AIR_SYSTEM_PROMPT,
         user_message_creator=create_user_message_air,
-        preprocess_func=preprocess_air
+        preprocess_func=preprocess_air,
+        api_columns=AIR_API_COLS,
+        slim_columns=["ticket_id", "thread_id", "inquiry_created_at"],
+        dtype_plan=AIR_DTYPE_PLAN
     ),
     "air2": DomainConfig(
         domain_name="air2",
+        id_column="ticket_id",
         input_columns=AIR2_COLS,
         system_prompt_template=SIMPLE_SYSTEM_PROMPT,
         user_message_creator=create_user_message_simple,
-        preprocess_func=preprocess_simple
+        preprocess_func=preprocess_simple,
+        api_columns=SIMPLE_API_COLS,
+        slim_columns=["ticket_id", "inquiry_created_at"],
+        dtype_plan=SIMPLE_DTYPE_PLAN
     ),
     "package": DomainConfig(
         domain_name="package",
+        id_column="ticket_id",
         input_columns=PACKAGE_COLS,
         system_prompt_template=SIMPLE_SYSTEM_PROMPT,
         user_message_creator=create_user_message_simple,
-        preprocess_func=preprocess_simple
+        preprocess_func=preprocess_simple,
+        api_columns=SIMPLE_API_COLS,
+        slim_columns=["ticket_id", "inquiry_created_at"],
+        dtype_plan=SIMPLE_DTYPE_PLAN
     )
 }
 
@@ -1,18 +1,276 @@
-
 import pandas as pd
+import numpy as np
 import os
-from typing import List, Dict, Any, Optional
-from config import DomainConfig
+from itertools import islice
+from typing import List, Dict, Any, Iterator, Optional, Sequence, Tuple
+from config import DomainConfig, CATEGORY_DTYPE, TEXT_DTYPE
 from utils import logger
 
-def load_data(file_path: str, config: DomainConfig, skip_preprocess: bool = False) -> pd.DataFrame:
+STREAM_CHUNK_ROWS = 1000  # 스트리밍 모드에서 한 번에 읽는 행 수
+
+# 확장자별 입력 형식
+INPUT_FORMATS = {
+    ".xlsx": "excel", ".xls": "excel",
+    ".csv": "csv",
+    ".parquet": "parquet", ".pq": "parquet",
+    ".feather": "feather", ".arrow": "feather",
+}
+
+def _input_format(file_path: str) -> str:
+    fmt = INPUT_FORMATS.get(os.path.splitext(file_path)[1].lower())
+    if fmt is None:
+        raise ValueError("Unsupported file format. Please use .xlsx, .csv, .parquet or .feather")
+    return fmt
+
+def _excel_header(file_path: str) -> List[str]:
+    """openpyxl read-only 모드로 첫 시트의 헤더 행만 읽는다 (read_excel 과 같은 이름 규칙)"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        header = list(next(workbook.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+    finally:
+        workbook.close()
+    while header and header[-1] is None:
+        header.pop()
+    return [f"Unnamed: {idx}" if name is None else name for idx, name in enumerate(header)]
+
+def _source_columns(file_path: str, fmt: str) -> List[str]:
+    """데이터는 읽지 않고 파일의 컬럼명만 읽는다"""
+    if fmt == "csv":
+        return list(pd.read_csv(file_path, nrows=0).columns)
+    if fmt == "excel":
+        return _excel_header(file_path)
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet/Feather input requires pyarrow (pip install pyarrow)")
+    if fmt == "parquet":
+        return pq.read_schema(file_path).names
+    with pa.memory_map(file_path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+def _target_columns(source_columns: Sequence[str], config: DomainConfig) -> List[str]:
+    """Rename columns to standard internal names"""
+
+    # 1. Positional Renaming (List)
+    if isinstance(config.input_columns, list):
+        if len(source_columns) == len(config.input_columns):
+             logger.info("Applied positional column renaming.")
+             return list(config.input_columns)
+        logger.warning(f"Column count mismatch. Expected {len(config.input_columns)}, got {len(source_columns)}. Skipping rename.")
+
+    # 2. Dictionary Mapping (Dict)
+    elif isinstance(config.input_columns, dict):
+        return [config.input_columns.get(name, name) for name in source_columns]
+
+    return list(source_columns)
+
+def _plan_columns(
+    file_path: str,
+    fmt: str,
+    config: DomainConfig,
+    columns: Optional[Sequence[str]],
+) -> Tuple[List[int], List[str], List[str]]:
+    """
+    파일 스키마(헤더)를 먼저 읽어 필요한 컬럼의 위치를 정한다.
+    columns 는 내부 표준 컬럼명이며, None 이면 모든 컬럼.
+    반환: (읽을 컬럼 위치, 파일 컬럼명, 내부 컬럼명)
+    """
+    source = _source_columns(file_path, fmt)
+    target = _target_columns(source, config)
+    if columns is None:
+        return list(range(len(source))), source, target
+
+    wanted = set(columns)
+    positions = [idx for idx, name in enumerate(target) if name in wanted]
+    missing = wanted - {target[idx] for idx in positions}
+    if missing:
+        logger.debug(f"Columns not found in input (skipped): {sorted(missing)}")
+    return positions, source, target
+
+def _read_frames(
+    file_path: str,
+    fmt: str,
+    positions: List[int],
+    source: List[str],
+    dtype: Optional[Dict[str, Any]],
+    chunk_size: Optional[int],
+) -> Iterator[pd.DataFrame]:
+    """
+    선택한 컬럼만 읽어서 chunk_size 행씩 반환 (chunk_size=None 이면 형식별로 한 번에 읽을 수 있는 단위).
+    반환되는 DataFrame 의 컬럼명은 파일 컬럼명 그대로.
+    """
+    names = [source[idx] for idx in positions]
+
+    if fmt == "csv":
+        # 명시한 dtype 은 타입 추론을 건너뛴다. 한 번에 읽을 때는 청크 목록을 concat 하지 않도록 한 번의 호출로 읽는다
+        if chunk_size is None:
+            yield pd.read_csv(file_path, usecols=positions, dtype=dtype)
+        else:
+            yield from pd.read_csv(file_path, usecols=positions, dtype=dtype, chunksize=chunk_size)
+
+    elif fmt == "excel":
+        if chunk_size is None:
+            yield pd.read_excel(file_path, engine='openpyxl', usecols=positions, dtype=dtype)
+            return
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(min_row=2, values_only=True)
+            while True:
+                block = list(islice(rows, chunk_size))
+                if not block:
+                    break
+                # 빈 행은 건너뛴다 (read_excel 과 동일)
+                block = [
+                    [row[idx] if idx < len(row) else None for idx in positions]
+                    for row in block if any(value is not None for value in row)
+                ]
+                if block:
+                    # 빈 셀은 read_excel 과 같이 NaN 으로
+                    yield _astype_like_reader(pd.DataFrame(block, columns=names).fillna(np.nan), dtype)
+        finally:
+            workbook.close()
+
+    else:
+        # Parquet/Feather 는 Arrow 테이블을 pandas 로 변환하는 시점에 dtype 적용
+        for table in _read_arrow_tables(file_path, fmt, names, chunk_size):
+            yield _arrow_frame(table, dtype)
+
+def _cell_text(value: Any) -> str:
+    # 엑셀 숫자 셀은 float 로 읽힐 수 있으므로 read_excel 과 같이 정수 값은 정수로 표시 (123.0 -> "123")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+def _astype_like_reader(frame: pd.DataFrame, dtype: Optional[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    읽은 뒤 dtype 적용. str 컬럼은 read_csv/read_excel(dtype=str) 과 같이 값만 문자열로 바꾸고 결측값은 그대로 둔다
+    (astype(str) 은 결측값을 "nan" 으로 바꿈).
+    """
+    if not dtype:
+        return frame
+    other = {col: kind for col, kind in dtype.items() if kind is not str}
+    if other:
+        frame = frame.astype(other)
+    for col, kind in dtype.items():
+        if kind is str:
+            frame[col] = frame[col].map(_cell_text, na_action="ignore")
+    return frame
+
+def _read_arrow_tables(file_path: str, fmt: str, names: List[str], chunk_size: Optional[int]) -> Iterator[Any]:
+    """선택한 컬럼만 pyarrow Table/RecordBatch 로 읽는다"""
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        if chunk_size is None:
+            yield pq.read_table(file_path, columns=names)
+            return
+        yield from pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size, columns=names)
+
+    else:  # feather
+        import pyarrow as pa
+
+        if chunk_size is None:
+            import pyarrow.feather as feather
+
+            yield feather.read_table(file_path, columns=names)
+            return
+        with pa.memory_map(file_path) as source_file:
+            reader = pa.ipc.open_file(source_file)
+            for batch_idx in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_idx).select(names)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    yield batch.slice(offset, chunk_size)
+
+def _arrow_frame(table: Any, dtype: Optional[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Arrow 테이블을 컬럼별로 DataFrame 으로 변환하면서 dtype 적용.
+    category 는 Arrow dictionary 로 인코딩해서, Arrow 문자열은 그대로 넘겨서 object 컬럼을 거치지 않는다.
     """
-    Loads data from an Excel or CSV file and normalizes columns based on domain config.
+    import pyarrow as pa
+
+    dtype = dict(dtype or {})
+    arrow_strings = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name)
+        kind = dtype.get(name)
+        if kind == "category":
+            if not pa.types.is_dictionary(column.type):
+                column = column.dictionary_encode()
+            columns[name] = column.to_pandas()
+            del dtype[name]
+        elif kind == "string[pyarrow]" and column.type in arrow_strings:
+            columns[name] = column.to_pandas(types_mapper=arrow_strings.get)
+            del dtype[name]
+        else:
+            columns[name] = column.to_pandas()
+    return _astype_like_reader(pd.DataFrame(columns), dtype)
+
+def _read_dtypes(config: DomainConfig, dtypes: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    id 컬럼은 항상 문자열로 읽는다. 타입 추론에 맡기면 빈 id 가 있는 컬럼은 float 이 되어
+    스트리밍(청크별 추론) 결과와 병합용 재읽기 결과의 id 가 달라진다 ("123" vs "123.0").
+    """
+    return {**(dtypes or {}), config.id_column: str}
+
+def _source_dtypes(dtypes: Optional[Dict[str, Any]], positions: List[int], source: List[str], target: List[str]):
+    """내부 컬럼명 기준 dtype 을 파일 컬럼명 기준으로 변환"""
+    if not dtypes:
+        return None
+    return {source[idx]: dtypes[target[idx]] for idx in positions if target[idx] in dtypes}
+
+def _text_dtype() -> Optional[str]:
+    try:
+        import pyarrow  # noqa: F401
+        return "string[pyarrow]"
+    except ImportError:
+        return None
+
+def plan_dtypes(dtype_plan: Dict[str, str]) -> Dict[str, str]:
+    """
+    도메인 dtype 계획을 pandas dtype 으로 변환 (CATEGORY_DTYPE → category, TEXT_DTYPE → string[pyarrow]).
+    pyarrow 가 없으면 텍스트 컬럼은 제외한다 (타입 추론 그대로). load_data/iter_data_chunks 의 dtypes 로 넘기면
+    파일을 읽는 시점에 적용되므로 전체 object 컬럼을 만든 뒤 변환하지 않는다.
+    """
+    text_dtype = _text_dtype()
+    dtypes = {}
+    for col, kind in dtype_plan.items():
+        if kind == CATEGORY_DTYPE:
+            dtypes[col] = "category"
+        elif kind == TEXT_DTYPE and text_dtype:
+            dtypes[col] = text_dtype
+    return dtypes
+
+def _log_memory(df: pd.DataFrame, dtypes: Optional[Dict[str, Any]]):
+    converted = sum(1 for col in (dtypes or {}) if col in df.columns)
+    logger.info(
+        f"Memory: {df.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB "
+        f"({converted} columns typed by dtype plan while reading)"
+    )
+
+def load_data(
+    file_path: str,
+    config: DomainConfig,
+    skip_preprocess: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    dtypes: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    """
+    Loads data from an Excel, CSV, Parquet or Feather file and normalizes columns based on domain config.
 
     Args:
-        file_path: 입력 파일 경로
+        file_path: 입력 파일 경로 (확장자로 형식 판단)
         config: 도메인 설정
         skip_preprocess: True면 전처리 없이 원본 반환 (컬럼 정규화만 수행)
+        columns: 읽을 컬럼 (내부 표준 컬럼명, None이면 전체). 파일 스키마를 먼저 읽어 해당 컬럼만 읽는다
+        dtypes: 내부 표준 컬럼명 → dtype (CSV/Excel 은 타입 추론 대신 사용, Parquet/Feather 는 읽은 뒤 변환).
+            보통 plan_dtypes(config.dtype_plan). id 컬럼은 항상 문자열로 읽는다
 
     Returns:
         DataFrame (skip_preprocess=True면 원본, False면 전처리 결과)
@@ -20,28 +278,15 @@ def load_data(file_path: str, config: DomainConfig, skip_preprocess: bool = Fals
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Input file not found: {file_path}")
 
+    fmt = _input_format(file_path)
     logger.info(f"Loading data from {file_path}...")
 
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, engine='openpyxl')
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path)
-    else:
-        raise ValueError("Unsupported file format. Please use .xlsx or .csv")
-
-    # Rename columns to standard internal names
-
-    # 1. Positional Renaming (List)
-    if isinstance(config.input_columns, list):
-        if len(df.columns) == len(config.input_columns):
-             df.columns = config.input_columns
-             logger.info("Applied positional column renaming.")
-        else:
-             logger.warning(f"Column count mismatch. Expected {len(config.input_columns)}, got {len(df.columns)}. Skipping rename.")
-
-    # 2. Dictionary Mapping (Dict)
-    elif isinstance(config.input_columns, dict):
-        df = df.rename(columns=config.input_columns)
+    positions, source, target = _plan_columns(file_path, fmt, config, columns)
+    read_dtypes = _source_dtypes(_read_dtypes(config, dtypes), positions, source, target)
+    # chunk_size=None 이면 모든 형식이 DataFrame 하나를 반환한다
+    df = next(_read_frames(file_path, fmt, positions, source, read_dtypes, None))
+    df.columns = [target[idx] for idx in positions]
+    _log_memory(df, dtypes)
 
     # skip_preprocess=True: 원본 데이터만 반환 (컬럼 정규화만 수행)
     if skip_preprocess:
@@ -59,6 +304,35 @@ def load_data(file_path: str, config: DomainConfig, skip_preprocess: bool = Fals
     logger.info(f"Preprocessed data: {len(df_processed)} rows ready for API.")
     return df_processed
 
+def iter_data_chunks(
+    file_path: str,
+    config: DomainConfig,
+    chunk_size: int = STREAM_CHUNK_ROWS,
+    columns: Optional[Sequence[str]] = None,
+    dtypes: Optional[Dict[str, Any]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    load_data(skip_preprocess=True) 와 같은 컬럼 정규화를 거친 원본 데이터를 chunk_size 행씩 반환한다.
+    전체 파일을 읽기 전에 첫 청크부터 처리할 수 있다 (스트리밍 모드).
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Input file not found: {file_path}")
+
+    fmt = _input_format(file_path)
+    positions, source, target = _plan_columns(file_path, fmt, config, columns)
+    read_dtypes = _source_dtypes(_read_dtypes(config, dtypes), positions, source, target)
+    frames = _read_frames(file_path, fmt, positions, source, read_dtypes, chunk_size)
+    internal_columns = [target[idx] for idx in positions]
+
+    logger.info(f"Streaming data from {file_path} ({chunk_size} rows per chunk)...")
+
+    def normalized_chunks():
+        for chunk in frames:
+            chunk.columns = internal_columns
+            yield chunk
+
+    return normalized_chunks()
+
 def load_categories(file_path: str) -> List[Dict[str, Any]]:
     """
     Loads category definitions from an Excel file.
@@ -96,10 +370,56 @@ def load_categories(file_path: str) -> List[Dict[str, Any]]:
     logger.info(f"Loaded {len(records)} category rules.")
     return records
 
-def save_results(df: pd.DataFrame, output_path: str):
+EXCEL_MAX_ROWS = 1_048_576  # 엑셀 시트당 최대 행 수 (헤더 포함)
+EXCEL_WRITE_CHUNK_ROWS = 50_000  # 엑셀에 쓸 때 한 번에 변환하는 행 수
+
+def _excel_rows(df: pd.DataFrame) -> Iterator[list]:
+    """DataFrame 행을 openpyxl 에 넘길 값 목록으로 (결측값은 빈 셀)"""
+    for start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+        block = df.iloc[start:start + EXCEL_WRITE_CHUNK_ROWS].astype(object)
+        block = block.where(block.notna(), None)
+        yield from (list(row) for row in block.itertuples(index=False, name=None))
+
+def _write_excel_sheets(df: pd.DataFrame, output_path: str, sheet_rows: int):
+    """write-only 모드(행을 바로 파일로 내보냄)로 sheet_rows 행마다 새 시트를 만들어 저장"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    header = [str(col) for col in df.columns]
+    sheet = None
+    for row_idx, row in enumerate(_excel_rows(df)):
+        if row_idx % sheet_rows == 0:
+            sheet = workbook.create_sheet(title=f"Sheet{row_idx // sheet_rows + 1}")
+            sheet.append(header)
+        sheet.append(row)
+    if sheet is None:
+        workbook.create_sheet(title="Sheet1").append(header)
+    workbook.save(output_path)
+
+def save_excel(df: pd.DataFrame, output_path: str, split: str = "sheets"):
+    """
+    엑셀 저장 (전체 워크북을 메모리에 만들지 않는 write-only 모드).
+    시트 행 수 한도(1,048,576)를 넘으면 split="sheets" 는 시트를 나누고 (Sheet1, Sheet2, ...),
+    split="files" 는 파일을 나눈다 (name_part1.xlsx, name_part2.xlsx, ...).
+    """
+    sheet_rows = EXCEL_MAX_ROWS - 1
+    if split == "files" and len(df) > sheet_rows:
+        base, ext = os.path.splitext(output_path)
+        num_parts = -(-len(df) // sheet_rows)
+        for part in range(num_parts):
+            part_path = f"{base}_part{part + 1}{ext}"
+            _write_excel_sheets(df.iloc[part * sheet_rows:(part + 1) * sheet_rows], part_path, sheet_rows)
+            logger.info(f"Saved rows {part * sheet_rows + 1}-{min((part + 1) * sheet_rows, len(df))} to {part_path}")
+        return
+
+    if len(df) > sheet_rows:
+        logger.info(f"{len(df)} rows exceed the Excel sheet limit; splitting into {-(-len(df) // sheet_rows)} sheets")
+    _write_excel_sheets(df, output_path, sheet_rows)
+
+def save_results(df: pd.DataFrame, output_path: str, excel_split: str = "sheets"):
     logger.info(f"Saving results to {output_path}...")
     if output_path.endswith('.csv'):
         df.to_csv(output_path, index=False, encoding='utf-8-sig')
     else:
-        df.to_excel(output_path, index=False, engine='openpyxl')
+        save_excel(df, output_path, split=excel_split)
     logger.info("Save complete.")
@@ -3,16 +3,20 @@ import os
 import argparse
 import asyncio
 import sys
-import pandas as pd
-import json
 from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI
+from dataclasses import replace
 from datetime import datetime
 import httpx
 
-from config import get_config
-from data_loader import load_data, save_results, load_categories
-from processor import process_api_requests, CheckpointManager
+from config import get_config, build_system_prompt, PROMPT_VERSION
+from data_loader import load_data, iter_data_chunks, plan_dtypes, save_results, load_categories
+from processor import process_api_requests, CheckpointManager, MAX_IN_FLIGHT, CACHED_TOKEN_TPM_DISCOUNT
+from categories import CategoryCodec
+from result_cache import ResultCache, DEFAULT_MAX_ENTRIES
+from result_sink import open_result_sink, read_results, merge_results
+from batch_planner import MAX_BATCH_ITEMS, TARGET_BATCH_INPUT_TOKENS
+from preprocessing import parallel_apply, DEFAULT_MAX_THREAD_TOKENS, MIN_MAX_THREAD_TOKENS
 from utils import logger
 
 # Load environment variables
@@ -65,11 +69,40 @@ def create_openai_client(api_key: str, api_version: str, endpoint: str) -> Async
 def main():
     parser = argparse.ArgumentParser(description="Local CS NER Processor")
     parser.add_argument("--domain", required=True, choices=["air", "air2", "package"], help="Domain to process")
-    parser.add_argument("--input", required=True, help="Input Excel/CSV file path")
+    parser.add_argument("--input", required=True, help="Input Excel/CSV/Parquet/Feather file path")
     parser.add_argument("--categories", required=True, help="Category definition Excel file path")
     parser.add_argument("--output", help="Output file path (default: auto-generated name)")
+    parser.add_argument("--slim-output", action="store_true",
+                        help="Write only identifier columns and the predicted levels to the output file")
+    parser.add_argument("--excel-split", choices=["sheets", "files"], default="sheets",
+                        help="How to split .xlsx output beyond 1,048,576 rows (default: sheets)")
+    parser.add_argument("--results-file",
+                        help="File the API results are appended to as batches complete, .csv or .jsonl (default: <output>_labels.csv)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes for masking/normalization (default: 1, small inputs always run serially)")
+    parser.add_argument("--max-thread-tokens", type=int, default=DEFAULT_MAX_THREAD_TOKENS,
+                        help=f"Air: token budget per thread; longer threads keep the first (truncated if needed) and most recent messages (default: {DEFAULT_MAX_THREAD_TOKENS} = no limit, minimum {MIN_MAX_THREAD_TOKENS})")
+    parser.add_argument("--stream", action="store_true",
+                        help="Air2/Package: start API requests while the input is still being read and masked")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help=f"Maximum number of concurrent API requests (default: {MAX_IN_FLIGHT})")
+    parser.add_argument("--max-batch-items", type=int, default=MAX_BATCH_ITEMS,
+                        help=f"Maximum number of items per API request (default: {MAX_BATCH_ITEMS})")
+    parser.add_argument("--batch-tokens", type=int, default=TARGET_BATCH_INPUT_TOKENS,
+                        help=f"Target input tokens per API request, excluding system prompt (default: {TARGET_BATCH_INPUT_TOKENS})")
+    parser.add_argument("--cached-token-discount", type=float, default=CACHED_TOKEN_TPM_DISCOUNT,
+                        help="Fraction of prompt-cached tokens returned to the TPM budget (default: 0)")
+    parser.add_argument("--cache", help="Result cache SQLite file path (reuses results for identical inquiries across runs)")
+    parser.add_argument("--cache-max-entries", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help=f"Maximum number of cached results; least recently used are evicted (default: {DEFAULT_MAX_ENTRIES})")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="Request JSON-schema structured output (requires a deployment/API version that supports it)")
+    parser.add_argument("--category-ids", action="store_true",
+                        help="Send short category IDs in the prompt and let the model answer with category_id")
 
     args = parser.parse_args()
+    if args.max_thread_tokens < 0 or 0 < args.max_thread_tokens < MIN_MAX_THREAD_TOKENS:
+        parser.error(f"--max-thread-tokens must be 0 (no limit) or at least {MIN_MAX_THREAD_TOKENS}")
 
     # 1. Load Configuration
     try:
@@ -79,6 +112,10 @@ def main():
         logger.error(str(e))
         return
 
+    if args.slim_output and config.slim_columns:
+        # 결과 파일에는 식별자 컬럼만 원본에서 읽어 병합
+        config = replace(config, passthrough_columns=config.slim_columns)
+
     # 2. Check API Keys
     api_key = os.getenv("AZURE_OPENAI_KEY")
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -89,43 +126,70 @@ def main():
         logger.error("Missing AZURE_OPENAI_KEY or AZURE_OPENAI_ENDPOINT in .env file.")
         return
 
-    # 3. Load Original Data (전처리 없이)
-    try:
-        original_df = load_data(args.input, config, skip_preprocess=True)
-        logger.info(f"Loaded {len(original_df)} rows with {len(original_df.columns)} columns")
-    except Exception as e:
-        logger.error(f"Failed to load input data: {e}")
-        return
-
-    # 4. Prepare API Data (도메인별 분기)
-    if config.domain_name == "air":
-        from preprocessing import mask_air, aggregate_by_thread
-
-        # 4-1. 마스킹 적용 (원본 행 수 유지)
-        masked_df = mask_air(original_df)
-        logger.info(f"After masking: {len(masked_df)} rows")
-
-        # 4-2. Thread 집계 (API 호출용)
-        api_df = aggregate_by_thread(masked_df)
-        logger.info(f"After thread aggregation: {len(api_df)} unique threads")
+    if args.stream and config.domain_name == "air":
+        # thread 집계에 모든 행이 필요하므로 Air 는 스트리밍 불가
+        logger.warning("--stream is not supported for the air domain. Loading the whole file.")
+        args.stream = False
+
+    # API 처리에는 config.api_columns 만 읽고, 나머지 원본 컬럼은 결과 병합 시점에 파일에서 다시 읽는다
+    # 도메인 dtype 계획(category, string[pyarrow])은 읽는 시점에 적용한다
+    input_dtypes = plan_dtypes(config.dtype_plan)
+    if args.stream:
+        # 3-4. 입력을 청크 단위로 읽고 마스킹하면서 바로 API 요청
+        try:
+            chunks = iter_data_chunks(args.input, config, columns=config.api_columns, dtypes=input_dtypes)
+        except Exception as e:
+            logger.error(f"Failed to load input data: {e}")
+            return
+        api_df = (config.preprocess_func(chunk) for chunk in chunks)
     else:
-        # air2, package: 기존 방식 유지
-        api_df = config.preprocess_func(original_df)
+        # 3. Load API Data (전처리 없이, API 처리에 필요한 컬럼만)
+        try:
+            input_df = load_data(args.input, config, skip_preprocess=True, columns=config.api_columns, dtypes=input_dtypes)
+            logger.info(f"Loaded {len(input_df)} rows with {len(input_df.columns)} columns")
+        except Exception as e:
+            logger.error(f"Failed to load input data: {e}")
+            return
+
+        # 4. Prepare API Data (도메인별 분기)
+        if config.domain_name == "air":
+            from preprocessing import mask_air, aggregate_by_thread
+
+            # 4-1. 마스킹 적용 (원본 행 수 유지, --workers 로 병렬 처리)
+            masked_df = parallel_apply(input_df, mask_air, args.workers)
+            logger.info(f"After masking: {len(masked_df)} rows")
+
+            # 4-2. Thread 집계 (API 호출용)
+            api_df = aggregate_by_thread(masked_df, max_thread_tokens=args.max_thread_tokens)
+            logger.info(f"After thread aggregation: {len(api_df)} unique threads")
+            del masked_df
+        else:
+            # air2, package: 기존 방식 유지 (--workers 로 병렬 처리)
+            api_df = parallel_apply(input_df, config.preprocess_func, args.workers)
+        del input_df
 
     # 5. Load Categories
     try:
         categories = load_categories(args.categories)
-        categories_json = json.dumps(categories, ensure_ascii=False)
+        # level1 → level2 → level3 트리로 압축 (실행마다 동일한 문자열이라 prompt caching 도 적중)
+        category_codec = CategoryCodec(categories, use_ids=args.category_ids)
     except Exception as e:
         logger.error(f"Failed to load categories: {e}")
         return
 
     # 6. Prepare System Prompt
-    system_msg = config.system_prompt_template.format(categories_json=categories_json)
+    system_msg = build_system_prompt(config, category_codec)
 
     # 7. Initialize Client (SSL 인증서 지원)
     client = create_openai_client(api_key, api_version, endpoint)
 
+    # 결과 캐시 (프롬프트 버전/도메인/배포/시스템 프롬프트가 같을 때만 재사용)
+    result_cache = None
+    if args.cache:
+        cache_context = "|".join([PROMPT_VERSION, config.domain_name, deployment, system_msg])
+        result_cache = ResultCache(args.cache, cache_context, max_entries=args.cache_max_entries)
+        logger.info(f"Using result cache: {args.cache}")
+
     # 8. Run Processing
     logger.info("Initializing Async API Processing...")
 
@@ -135,58 +199,97 @@ def main():
         logger.info(f"[Resume] 이전 체크포인트 발견: {checkpoint_mgr.checkpoint_path}")
         logger.info("[Resume] 중단된 지점부터 이어서 처리합니다.")
 
+    # 결과 파일 경로 (API 결과는 배치가 끝날 때마다 results_path 에 추가되어 실행 중에도 확인 가능)
+    if args.output:
+        output_path = args.output
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        input_name = os.path.splitext(os.path.basename(args.input))[0]
+        output_path = f"{input_name}_result_{timestamp}.csv"
+    results_path = args.results_file or f"{os.path.splitext(output_path)[0]}_labels.csv"
+    result_sink = open_result_sink(results_path, config.id_column)
+    logger.info(f"Writing API results to {results_path} as batches complete")
+
     start_time = datetime.now()
 
-    results = asyncio.run(process_api_requests(
-        data_df=api_df,
-        config=config,
-        system_msg=system_msg,
-        client=client,
-        deployment_name=deployment,
-        input_file=args.input
-    ))
+    try:
+        asyncio.run(process_api_requests(
+            data_df=api_df,
+            config=config,
+            system_msg=system_msg,
+            client=client,
+            deployment_name=deployment,
+            input_file=args.input,
+            max_in_flight=args.max_in_flight,
+            max_batch_items=args.max_batch_items,
+            target_batch_tokens=args.batch_tokens,
+            cached_token_discount=args.cached_token_discount,
+            category_codec=category_codec,
+            structured_output=args.structured_output,
+            result_cache=result_cache,
+            result_sink=result_sink,
+            # 병합/저장이 실패해도 다시 실행하면 API 호출 없이 체크포인트에서 결과를 복구하도록 저장 후에 삭제
+            keep_checkpoint=True
+        ))
+    except KeyboardInterrupt:
+        logger.warning("[Interrupted] 처리가 중단되었습니다. 다시 실행하면 체크포인트부터 이어서 처리합니다.")
+        return
+    finally:
+        result_sink.close()
+        if result_cache is not None:
+            result_cache.close()
+
+    # 원본을 다시 읽기 전에 API 입력 데이터 해제
+    del api_df
 
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
     logger.info(f"Processing finished in {duration:.1f} seconds.")
 
     # 9. Merge Results with ORIGINAL Data (핵심!)
-    if not results:
+    # 병합 키 결정
+    id_col = config.id_column
+
+    results_df = read_results(results_path, id_col)
+    if results_df.empty:
         logger.warning("No results generated.")
         return
 
-    results_df = pd.DataFrame(results)
-
-    # 병합 키 결정
-    id_col = "thread_id" if config.domain_name == "air" else "ticket_id"
-
     if id_col not in results_df.columns:
         logger.error(f"Results missing ID column {id_col}. Cannot merge.")
         save_results(results_df, "raw_results_error.csv")
         return
 
-    # 타입 일치
-    original_df[id_col] = original_df[id_col].astype(str)
-    results_df[id_col] = results_df[id_col].astype(str)
+    # 원본 컬럼(passthrough)은 API 처리가 끝난 뒤 파일에서 다시 읽는다
+    try:
+        original_df = load_data(
+            args.input, config, skip_preprocess=True, columns=config.output_columns(), dtypes=input_dtypes
+        )
+    except Exception as e:
+        logger.error(f"Failed to load input data for merge: {e}")
+        save_results(results_df, "raw_results_error.csv")
+        return
+
+    if config.domain_name != "air":
+        # air2, package: 다시 읽은 원본 content 도 API 처리 때와 같이 마스킹 (결과 파일에 전화번호가 남지 않도록)
+        original_df = parallel_apply(original_df, config.preprocess_func, args.workers)
 
     # LEFT JOIN: 원본 데이터 기준 병합 (핵심!)
     # Air: 99행 original + 64개 thread 결과 → 99행 출력
-    final_df = pd.merge(original_df, results_df, on=id_col, how="left")
+    final_df = merge_results(original_df, results_df, id_col)
 
     logger.info(f"Final output: {len(final_df)} rows, {len(final_df.columns)} columns")
 
     # 10. Save Results
-    if args.output:
-        output_path = args.output
-    else:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        input_name = os.path.splitext(os.path.basename(args.input))[0]
-        output_path = f"{input_name}_result_{timestamp}.csv"
-
     try:
-        save_results(final_df, output_path)
+        save_results(final_df, output_path, excel_split=args.excel_split)
     except Exception as e:
         logger.error(f"Failed to save results: {e}")
+        logger.error(f"API 결과는 체크포인트({checkpoint_mgr.checkpoint_path})에 남아 있습니다. 다시 실행하면 API 호출 없이 이어서 처리합니다.")
+        return
+
+    # 결과 파일까지 저장한 뒤에 체크포인트 삭제
+    checkpoint_mgr.cleanup()
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,79 @@
 
 import re
+import math
+import numpy as np
 import pandas as pd
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from utils import logger, count_tokens, count_tokens_many
 
 # Regex Patterns
 PASSPORT_RE = re.compile(r'\bM[A-Za-z0-9]{8}\b')
 PHONE_RE = re.compile(r'\b010-?\d{4}-?\d{4}\b')
 PHONE_WIDE_RE = re.compile(r'(?:\+82[-\s\.]?)?0?1[0-9][-\s\.]?\d{3,4}[-\s\.]?\d{4}')
 
+MASKED_VALUE = "<MASKED_VALUE>"
+_MASK_SENTINEL = "\ue000"  # 마스킹 중 임시 표시 (유니코드 사용자 정의 영역 문자)
+
+# 병렬 전처리: 이보다 행 수가 적으면 프로세스 생성/직렬화 비용이 더 커서 직렬로 처리
+PARALLEL_MIN_ROWS = 20000
+CHUNKS_PER_WORKER = 4  # 워커당 청크 수 (청크별 처리 시간 편차 완화)
+
+# 긴 thread 압축: 첫 메시지와 최근 메시지 사이에 넣는 생략 표시
+DEFAULT_MAX_THREAD_TOKENS = 0  # thread 하나의 content 토큰 예산 (기본값 0: 제한 없음, 기존과 같은 content 전송)
+THREAD_ELISION_MARKER = "[... 중간 메시지 {count}개 생략 ...]"
+MESSAGE_TRUNCATION_MARKER = "[... 이하 생략 ...]"  # 예산에 맞춰 자른 메시지 끝에 붙이는 표시
+ELISION_MARKER_TOKENS = 20  # 생략 표시 토큰 수 여유분
+# 최소 thread 토큰 예산 (생략 표시 두 개를 빼고도 문의 본문이 남도록)
+MIN_MAX_THREAD_TOKENS = 10 * ELISION_MARKER_TOKENS
+def _scan_literals(text: str, literals: List[str]) -> str:
+    """literals(긴 값부터)를 앞에서부터 찾아 치환 (같은 위치면 가장 긴 값). 치환한 표시 안은 다시 검사하지 않는다"""
+    positions = [text.find(v) for v in literals]
+    parts = []
+    pos = 0
+    while True:
+        best = -1
+        for idx, found in enumerate(positions):
+            if found != -1 and (best == -1 or found < positions[best]):
+                best = idx
+        if best == -1:
+            break
+        start = positions[best]
+        parts.append(text[pos:start])
+        parts.append(MASKED_VALUE)
+        pos = start + len(literals[best])
+        # 치환한 구간과 겹치는 위치는 그 뒤에서 다시 찾는다
+        positions = [found if found == -1 or found >= pos else text.find(literals[idx], pos)
+                     for idx, found in enumerate(positions)]
+    parts.append(text[pos:])
+    return "".join(parts)
+
+def mask_literals(text: str, values: Sequence[Optional[str]]) -> str:
+    """
+    여러 리터럴 값을 마스킹 (빈 값/None 은 무시). 긴 값부터 str.replace 로 치환한다.
+    값이 마스킹 표시와 겹칠 수 있으면 값에 나올 수 없는 sentinel 문자로 바꿔 두었다가 마지막에 MASKED_VALUE 로
+    바꾸므로 짧은 값이 이미 넣은 마스킹 표시 안에서 다시 매칭되지 않는다.
+    행마다 값 조합이 달라 (inquirer_id, reservation_number 등) 정규식을 컴파일하지 않는다.
+    """
+    # 본문에 없는 값은 제외 (대부분의 값은 여기서 걸러짐)
+    literals = [v for v in values if v and v in text]
+    if not literals:
+        return text
+    if len(literals) == 1:
+        return text.replace(literals[0], MASKED_VALUE)
+    literals.sort(key=len, reverse=True)
+    # 마스킹 표시 안에 있거나 표시 경계("<", ">")에 걸칠 수 있는 값이 없으면 바로 치환
+    if not any("<" in v or ">" in v or v in MASKED_VALUE for v in literals):
+        for value in literals:
+            text = text.replace(value, MASKED_VALUE)
+        return text
+    if _MASK_SENTINEL in text:
+        return _scan_literals(text, literals)
+    for value in literals:
+        text = text.replace(value, _MASK_SENTINEL)
+    return text.replace(_MASK_SENTINEL, MASKED_VALUE)
+
 def mask_text_simple(text: str) -> str:
     """Masks phone numbers only (Air2/Package style)."""
     if not isinstance(text, str):
@@ -21,15 +87,9 @@ def mask_text_advanced(text: str, mask_vals: List[str] = None) -> str:
     if not isinstance(text, str):
         return ""
     
-    # 1. Mask specific column values if provided
+    # 1. Mask specific column values if provided (한 번의 스캔으로 모든 값 치환)
     if mask_vals:
-        for val in mask_vals:
-            if val and str(val).strip():
-                # Escape to treat as literal, replace with generic mask
-                try:
-                    text = re.sub(re.escape(str(val)), "<MASKED_VALUE>", text)
-                except Exception:
-                    pass
+        text = mask_literals(text, [str(val) for val in mask_vals if val and str(val).strip()])
 
     # 2. Passport
     text = PASSPORT_RE.sub("<MASKED_PASSPORT>", text)
@@ -39,6 +99,40 @@ def mask_text_advanced(text: str, mask_vals: List[str] = None) -> str:
     
     return text
 
+# Air 마스킹 대상 개인정보 컬럼
+AIR_MASK_COLS = ["inquirer_id", "inquirer_name", "inquiry_status", "reservation_number", "destination"]
+
+
+def _text_column(df: pd.DataFrame, col: str) -> List[str]:
+    """행 단위 str(row.get(col, "")) 와 같은 변환 (결측값도 str() 결과 그대로)"""
+    if col not in df.columns:
+        return [""] * len(df)
+    series = df[col]
+    if isinstance(series.dtype, pd.StringDtype):
+        # Arrow 문자열 컬럼의 결측값(pd.NA)도 object 컬럼의 NaN 과 같은 "nan" 으로
+        return [str(v) for v in series.to_numpy(dtype=object, na_value=float("nan"))]
+    return [str(v) for v in series]
+
+
+def _literal_mask_values(series: pd.Series) -> List[Optional[str]]:
+    """mask_text_advanced 와 같은 기준으로 행별 마스킹 값 (마스킹하지 않는 값은 None)"""
+    return [str(v) if v and str(v).strip() else None for v in series]
+
+
+def _mask_text_column(texts: List[str], mask_values: List[List[Optional[str]]]) -> List[str]:
+    """
+    mask_text_advanced 를 컬럼 단위로 적용.
+    1. 행별 값 마스킹: 행의 모든 마스킹 값을 mask_literals 로 한 번에 치환
+    2. 여권/전화번호: 컬럼 전체에 .str.replace 로 한 번에 적용
+    """
+    if mask_values:
+        texts = [mask_literals(t, row_values) for t, row_values in zip(texts, zip(*mask_values))]
+    result = pd.Series(texts, dtype=object)
+    result = result.str.replace(PASSPORT_RE, "<MASKED_PASSPORT>", regex=True)
+    result = result.str.replace(PHONE_RE, "<MASKED_PHONE>", regex=True)
+    return result.tolist()
+
+
 def mask_air(df: pd.DataFrame) -> pd.DataFrame:
     """
     Air 도메인 마스킹 (개별 ticket 레벨)
@@ -53,47 +147,130 @@ def mask_air(df: pd.DataFrame) -> pd.DataFrame:
         df = df.copy()
 
     # Columns to mask (if they exist)
-    mask_cols = ["inquirer_id", "inquirer_name", "inquiry_status", "reservation_number", "destination"]
+    mask_cols = [c for c in AIR_MASK_COLS if c in df.columns]
+    mask_values = [_literal_mask_values(df[c]) for c in mask_cols]
 
-    def apply_mask(row):
-        cols_vals = [row[c] for c in mask_cols if c in row]
-        # Mask both title and content
-        t = str(row.get("inquiry_title", ""))
-        c = str(row.get("inquiry_content", ""))
-        return mask_text_advanced(t, cols_vals), mask_text_advanced(c, cols_vals)
-
-    # Apply masking
-    mask_results = df.apply(apply_mask, axis=1)
-    df["title_anon"] = [x[0] for x in mask_results]
-    df["content_anon"] = [x[1] for x in mask_results]
+    # Mask both title and content (컬럼 단위로 일괄 처리, 결과는 mask_text_advanced 와 동일)
+    df["title_anon"] = _mask_text_column(_text_column(df, "inquiry_title"), mask_values)
+    df["content_anon"] = _mask_text_column(_text_column(df, "inquiry_content"), mask_values)
 
     return df
 
 
-def aggregate_by_thread(df: pd.DataFrame) -> pd.DataFrame:
+def _join_groups(values, starts: np.ndarray, ends: np.ndarray) -> List[str]:
+    """그룹(연속 구간)별로 값이 있는 항목만 공백으로 연결 (" ".join(str(s) for s in x if s) 와 동일)"""
+    texts = [str(v) if v else "" for v in values]
+    return [" ".join(filter(None, texts[start:end])) for start, end in zip(starts, ends)]
+
+
+def _truncate_message(message: str, tokens: int, max_tokens: int) -> Tuple[str, int]:
+    """메시지를 max_tokens 안으로 자르고 끝에 MESSAGE_TRUNCATION_MARKER 를 붙인다. 반환: (텍스트, 자른 부분 토큰 수)"""
+    if tokens <= max_tokens:
+        return message, tokens
+    # 토큰 수에 비례해서 자른 뒤 예산 안에 들어올 때까지 줄인다
+    keep = len(message) * max(0, max_tokens) // tokens
+    kept_tokens = count_tokens(message[:keep]) if keep else 0
+    while keep and kept_tokens > max_tokens:
+        keep = keep * 9 // 10
+        kept_tokens = count_tokens(message[:keep]) if keep else 0
+    return f"{message[:keep].rstrip()} {MESSAGE_TRUNCATION_MARKER}".lstrip(), kept_tokens
+
+
+def _compact_messages(messages: List[str], tokens: List[int], max_tokens: int) -> Optional[List[str]]:
+    """
+    첫 메시지 + 예산 안에 들어가는 가장 최근 메시지들만 남기고 사이에 생략 표시를 넣는다.
+    첫 메시지는 최근 메시지들을 채우고 남은 예산(최소 절반)에 맞춰 자르므로 결과는 항상 max_tokens 이하이다
+    (메시지가 하나뿐인 thread 도 잘린다). 예산 안이면 None.
+    """
+    # 메시지 사이 공백 하나당 1 토큰으로 계산
+    if sum(tokens) + len(messages) - 1 <= max_tokens:
+        return None
+    # 첫 메시지 자름 표시와 중간 생략 표시 자리를 미리 뺀다
+    budget = max_tokens - 2 * ELISION_MARKER_TOKENS
+    first_share = min(tokens[0], budget // 2)
+    recent_budget = budget - first_share
+    keep_from = len(messages)
+    while keep_from > 1 and tokens[keep_from - 1] + 1 <= recent_budget:
+        keep_from -= 1
+        recent_budget -= tokens[keep_from] + 1
+    first, _ = _truncate_message(messages[0], tokens[0], first_share + recent_budget)
+    elided = keep_from - 1
+    if not elided:
+        return [first] + messages[keep_from:]
+    return [first, THREAD_ELISION_MARKER.format(count=elided)] + messages[keep_from:]
+
+
+def _join_groups_within_budget(values, starts: np.ndarray, ends: np.ndarray, max_tokens: int) -> Tuple[List[str], int]:
+    """
+    _join_groups 와 같지만 thread 별 토큰 예산(max_tokens)을 넘으면 _compact_messages 로 줄인다.
+    반환: (연결된 텍스트 목록, 줄어든 thread 수)
+    """
+    texts = [str(v) if v else "" for v in values]
+    groups = [[t for t in texts[start:end] if t] for start, end in zip(starts, ends)]
+
+    # 토큰 수 <= UTF-8 바이트 수 <= 글자 수 * 4 이므로 글자 수로 예산을 넘을 수 있는 thread 만 토큰 수를 센다
+    candidates = [idx for idx, messages in enumerate(groups) if 4 * sum(map(len, messages)) > max_tokens]
+    token_counts = iter(count_tokens_many([t for idx in candidates for t in groups[idx]]))
+
+    num_compacted = 0
+    for idx in candidates:
+        messages = groups[idx]
+        compacted = _compact_messages(messages, [next(token_counts) for _ in messages], max_tokens)
+        if compacted is not None:
+            groups[idx] = compacted
+            num_compacted += 1
+    return [" ".join(messages) for messages in groups], num_compacted
+
+
+def aggregate_by_thread(df: pd.DataFrame, max_thread_tokens: Optional[int] = None) -> pd.DataFrame:
     """
     Thread별 집계 (API 호출용)
     - groupby thread_id
     - content 시간순 연결
-    - 반환: thread_id별 1행
+    - max_thread_tokens 가 있으면 이를 넘는 thread 의 content 는 첫 메시지 + 최근 메시지만 남긴다
+      (MIN_MAX_THREAD_TOKENS 보다 작으면 MIN_MAX_THREAD_TOKENS 로 올림)
+      (첫 메시지도 남은 예산에 맞춰 자르므로 content 는 항상 max_thread_tokens 이하)
+      (줄어든 thread 수는 로그와 df_agg.attrs["num_compacted_threads"] 에 기록)
+    - 반환: thread_id별 1행 (thread_id 정렬 순서)
+    groupby().agg(파이썬 함수) 대신 factorize 한 thread 코드로 행을 한 번 정렬한 뒤
+    그룹 경계 구간을 잘라 title/content 를 같은 패스에서 연결한다.
     """
     if "thread_id" not in df.columns:
         raise ValueError("Air domain requires 'thread_id' column for aggregation.")
+    if max_thread_tokens and max_thread_tokens < MIN_MAX_THREAD_TOKENS:
+        # 예산이 생략 표시보다 작으면 본문 없이 표시만 남으므로 최소값으로 올린다
+        logger.warning(f"max_thread_tokens {max_thread_tokens} is too small; using {MIN_MAX_THREAD_TOKENS}")
+        max_thread_tokens = MIN_MAX_THREAD_TOKENS
 
-    # Sort by time first to ensure concat order
-    if "inquiry_created_at" in df.columns:
-        df = df.sort_values("inquiry_created_at")
+    # Sort by time first to ensure concat order (이미 시간순이면 정렬 생략, 같은 시각은 입력 순서 유지)
+    if "inquiry_created_at" in df.columns and not df["inquiry_created_at"].is_monotonic_increasing:
+        df = df.sort_values("inquiry_created_at", kind="mergesort")
 
-    # helper for aggregation: join with space
-    def join_text(x):
-        return " ".join([str(s) for s in x if s])
+    # thread_id → 정렬된 그룹 코드 (결측 thread_id 는 -1 로 제외, groupby 기본 동작과 동일)
+    codes, thread_ids = pd.factorize(df["thread_id"], sort=True)
+    rows = np.flatnonzero(codes >= 0)
+    codes = codes[rows]
+    if len(codes) > 1 and np.any(codes[1:] < codes[:-1]):
+        # 같은 thread 행을 모으되 시간 순서는 유지 (stable)
+        order = np.argsort(codes, kind="stable")
+        rows, codes = rows[order], codes[order]
 
-    agg_rules = {
-        "title_anon": join_text,
-        "content_anon": join_text,
-    }
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(codes)]
 
-    df_agg = df.groupby("thread_id", as_index=False).agg(agg_rules)
+    columns = {"thread_id": thread_ids[codes[starts]] if len(codes) else thread_ids[:0]}
+    num_compacted = 0
+    for col in ("title_anon", "content_anon"):
+        values = df[col].to_numpy(dtype=object)[rows] if col in df.columns else [""] * len(rows)
+        if col == "content_anon" and max_thread_tokens:
+            # API 로 전송되는 content 만 토큰 예산 적용
+            columns[col], num_compacted = _join_groups_within_budget(values, starts, ends, max_thread_tokens)
+        else:
+            columns[col] = _join_groups(values, starts, ends)
+    df_agg = pd.DataFrame(columns)
+    df_agg.attrs["num_compacted_threads"] = num_compacted
+    if num_compacted:
+        logger.info(f"Compacted {num_compacted}/{len(df_agg)} threads over {max_thread_tokens} tokens")
 
     # Rename to expected output: 'content' for the processor
     df_agg = df_agg.rename(columns={"content_anon": "content"})
@@ -127,3 +304,25 @@ def preprocess_simple(df: pd.DataFrame) -> pd.DataFrame:
     df["content"] = df["content"].apply(mask_text_simple)
     
     return df
+
+
+def parallel_apply(
+    df: pd.DataFrame,
+    func: Callable[[pd.DataFrame], pd.DataFrame],
+    workers: int = 1,
+    min_rows: int = PARALLEL_MIN_ROWS,
+) -> pd.DataFrame:
+    """
+    행 단위 전처리 함수(mask_air, preprocess_simple 등)를 청크로 나눠 프로세스 풀에서 실행하고
+    원래 순서대로 합친다. func 는 행끼리 독립적이어야 하며 모듈 최상위 함수여야 한다 (pickle 가능).
+    workers <= 1 이거나 행 수가 min_rows 미만이면 직렬로 처리한다.
+    """
+    if workers <= 1 or len(df) < min_rows:
+        return func(df)
+
+    chunk_size = math.ceil(len(df) / (workers * CHUNKS_PER_WORKER))
+    chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map 은 입력 순서대로 결과를 돌려준다
+        results = list(executor.map(func, chunks))
+    return pd.concat(results)
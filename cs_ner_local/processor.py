@@ -5,73 +5,233 @@ import time
 import re
 import os
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-from dataclasses import dataclass, field
+import queue
+import threading
+from collections import deque
+from typing import List, Dict, Any, Deque, Iterable, Optional, Set, Union
+from dataclasses import dataclass, field, replace
 from openai import AsyncAzureOpenAI
 import pandas as pd
 # import nest_asyncio
 
-from utils import logger, StatusTracker, count_tokens
+from utils import logger, StatusTracker, count_tokens, count_tokens_many
+from rate_limiter import RateLimiter
+from batch_planner import (
+    plan_batches, MAX_OUTPUT_TOKENS, MIN_BATCH_ITEMS, MAX_BATCH_ITEMS, TARGET_BATCH_INPUT_TOKENS
+)
 from config import DomainConfig
+from categories import CategoryCodec
+from response_parser import build_response_format, extract_complete_items, extract_json_items, validate_items
+from result_cache import ResultCache, collapse_duplicates, fan_out_results
+from result_sink import ResultSink, MemoryResultSink
 
 # Apply nest_asyncio to allow nested event loops if necessary
 # nest_asyncio.apply()
 
 # Constants for Rate Limiting
-BATCH_SIZE = 5
 CHUNK_LOG = 10
 SECONDS_TO_PAUSE_AFTER_RATE_LIMIT = 15
-SECONDS_TO_SLEEP_EACH_LOOP = 0.001
-CHECKPOINT_INTERVAL = 10  # 10 배치(50건)마다 체크포인트 저장
+FSYNC_INTERVAL = 20  # 체크포인트 저널에 20번 추가할 때마다 fsync
+COMPACT_ROWS_PER_LINE = 1000  # 저널 정리 시 한 줄에 담을 결과 수
+MAX_IN_FLIGHT = 50  # 동시에 진행 중인 API 요청 최대 개수
+RESERVED_TOKENS_PER_ITEM = 100  # Rate limit 계산 시 항목당 응답 토큰 예약분
+# prompt cache 적중 토큰을 TPM 용량으로 되돌려 줄 비율.
+# 캐시 토큰이 TPM 한도에 집계되지 않는 배포에서만 1.0 등으로 올린다.
+CACHED_TOKEN_TPM_DISCOUNT = 0.0
 
 
 class CheckpointManager:
-    """체크포인트 저장/복구 관리자"""
+    """
+    체크포인트 저장/복구 관리자.
+    JSON Lines 저널 형식: 첫 줄은 헤더, 이후 완료된 배치 결과를 한 줄씩 추가만 한다.
+    - 저장 비용은 새 결과 크기에만 비례 (전체 결과를 다시 쓰지 않음)
+    - 파일 쓰기는 전용 writer 스레드가 큐에서 꺼내 수행하므로 디스패처는 디스크를 기다리지 않음
+    - fsync 는 FSYNC_INTERVAL 번 추가할 때마다 한 번씩 묶어서 수행
+    - 재개 시 저널 정리(compact)는 임시 파일에 쓴 뒤 rename 으로 한 번에 교체
+    """
 
     def __init__(self, input_file: str, domain: str):
         # 입력 파일명 기반으로 체크포인트 파일명 생성
         base_name = os.path.splitext(os.path.basename(input_file))[0]
-        self.checkpoint_path = f"{base_name}_{domain}_checkpoint.json"
+        self.checkpoint_path = f"{base_name}_{domain}_checkpoint.jsonl"
         self.domain = domain
         self.input_file = input_file
+        self._file = None
+        self._appends_since_sync = 0
+        self._queue: "queue.Queue[Optional[List[Dict]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        # 쓰기 지연 지표
+        self.num_writes = 0
+        self.total_write_seconds = 0.0
+        self.max_write_seconds = 0.0
 
     def exists(self) -> bool:
         """체크포인트 파일 존재 여부"""
         return os.path.exists(self.checkpoint_path)
 
-    def save(self, results: List[Dict], processed_batch_idx: int, total_batches: int):
-        """현재 진행상황 저장"""
-        checkpoint_data = {
+    def _header_line(self) -> str:
+        header = {
             "timestamp": datetime.now().isoformat(),
             "input_file": self.input_file,
             "domain": self.domain,
-            "processed_batch_idx": processed_batch_idx,
-            "total_batches": total_batches,
-            "results": results
         }
-        with open(self.checkpoint_path, 'w', encoding='utf-8') as f:
-            json.dump(checkpoint_data, f, ensure_ascii=False, indent=2)
-        logger.info(f"Checkpoint saved: {processed_batch_idx}/{total_batches} batches ({len(results)} items)")
+        return json.dumps({"header": header}, ensure_ascii=False) + "\n"
+
+    def _open(self):
+        if self._file is not None:
+            return
+        is_new = not self.exists() or os.path.getsize(self.checkpoint_path) == 0
+        needs_newline = False
+        if not is_new:
+            # 이전 실행이 줄 중간에서 끊겼다면 새 줄부터 이어 쓴다
+            with open(self.checkpoint_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(self.checkpoint_path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._file.write("\n")
+        if is_new:
+            self._file.write(self._header_line())
+
+    def append(self, results: List[Dict]):
+        """완료된 배치 결과를 저널에 추가 (writer 스레드에서 호출)"""
+        if not results:
+            return
+        start = time.perf_counter()
+        self._open()
+        self._file.write(json.dumps({"results": results}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._appends_since_sync += 1
+        if self._appends_since_sync >= FSYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._appends_since_sync = 0
+        elapsed = time.perf_counter() - start
+        self.num_writes += 1
+        self.total_write_seconds += elapsed
+        self.max_write_seconds = max(self.max_write_seconds, elapsed)
+
+    def _run_writer(self):
+        while True:
+            results = self._queue.get()
+            if results is None:
+                break
+            try:
+                self.append(results)
+            except Exception as e:
+                logger.error(f"Failed to write checkpoint: {e}")
+
+    def submit(self, results: List[Dict]):
+        """결과를 writer 스레드 큐에 넣고 바로 반환 (이벤트 루프를 막지 않음)"""
+        if not results:
+            return
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run_writer, name="checkpoint-writer", daemon=True)
+            self._writer.start()
+        self._queue.put(results)
+
+    def compact(self, results: List[Dict]):
+        """저널을 주어진 결과만 담은 새 파일로 교체 (임시 파일에 쓴 뒤 원자적으로 rename)"""
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self._header_line())
+            for start in range(0, len(results), COMPACT_ROWS_PER_LINE):
+                chunk = results[start:start + COMPACT_ROWS_PER_LINE]
+                f.write(json.dumps({"results": chunk}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
 
     def load(self) -> Optional[Dict]:
-        """체크포인트 로드"""
+        """저널을 처음부터 재생하여 저장된 결과를 복구 (끊긴 마지막 줄은 무시)"""
         if not self.exists():
             return None
+        results = []
+        num_batches = 0
         try:
             with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            logger.info(f"Checkpoint loaded: {data['processed_batch_idx']}/{data['total_batches']} batches")
-            return data
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping corrupted checkpoint line {line_no}")
+                        continue
+                    if "results" in entry:
+                        results.extend(entry["results"])
+                        num_batches += 1
         except Exception as e:
             logger.warning(f"Failed to load checkpoint: {e}")
             return None
+        logger.info(f"Checkpoint loaded: {num_batches} batches ({len(results)} items)")
+        return {"results": results, "num_batches": num_batches}
+
+    def log_stats(self):
+        if self.num_writes:
+            avg_ms = self.total_write_seconds / self.num_writes * 1000
+            logger.info(
+                f"Checkpoint writes: {self.num_writes}, avg {avg_ms:.2f} ms, max {self.max_write_seconds * 1000:.2f} ms"
+            )
+
+    def close(self):
+        """큐에 남은 쓰기를 마치고 fsync 후 파일을 닫는다"""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        self.log_stats()
 
     def cleanup(self):
         """완료 후 체크포인트 삭제"""
+        self.close()
         if self.exists():
             os.remove(self.checkpoint_path)
             logger.info(f"Checkpoint file removed: {self.checkpoint_path}")
 
+@dataclass
+class RequestCostModel:
+    """
+    요청별 토큰 소모량 추정 (Rate Limit 용).
+    시스템 프롬프트 토큰 수는 실행당 한 번만 계산하고,
+    user message 는 한 번만 렌더링해서 측정과 실제 요청에 함께 사용한다.
+    """
+    system_msg: str
+    config: DomainConfig
+    category_codec: Optional[CategoryCodec] = None
+    structured_output: bool = False
+    system_tokens: int = field(init=False)
+    response_format: Optional[Dict[str, Any]] = field(init=False)
+
+    def __post_init__(self):
+        self.system_tokens = count_tokens(self.system_msg)
+        use_category_ids = self.category_codec is not None and self.category_codec.use_ids
+        self.response_format = (
+            build_response_format(self.config.id_column, use_category_ids) if self.structured_output else None
+        )
+
+    def build_request(self, task_id: int, batch_items: List[Dict[str, Any]], max_attempts: int) -> "APIRequest":
+        use_category_ids = self.category_codec is not None and self.category_codec.use_ids
+        user_msg = self.config.user_message_creator(batch_items, use_category_ids=use_category_ids)
+        # user message 는 배치마다 달라 캐시 효과가 없으므로 LRU 캐시를 거치지 않는 count_tokens_many 사용
+        user_tokens = count_tokens_many([user_msg])[0]
+        return APIRequest(
+            task_id=task_id,
+            batch_items=batch_items,
+            token_consumption=self.system_tokens + user_tokens + RESERVED_TOKENS_PER_ITEM * len(batch_items),
+            attempts_left=max_attempts,
+            system_msg=self.system_msg,
+            config=self.config,
+            user_msg=user_msg,
+            category_codec=self.category_codec,
+            response_format=self.response_format,
+        )
+
+
 @dataclass
 class APIRequest:
     task_id: int
@@ -80,19 +240,25 @@ class APIRequest:
     attempts_left: int
     system_msg: str
     config: DomainConfig
-    user_msg: str = field(init=False)
+    user_msg: str = ""
+    category_codec: Optional[CategoryCodec] = None
+    response_format: Optional[Dict[str, Any]] = None
     result: List[Dict[str, Any]] = field(default_factory=list)
     error_msg: str = ""
 
     def __post_init__(self):
         # Use the domain-specific function to create user message
-        self.user_msg = self.config.user_message_creator(self.batch_items)
+        # (RequestCostModel 로 이미 렌더링한 메시지가 있으면 그대로 사용)
+        if not self.user_msg:
+            self.user_msg = self.config.user_message_creator(self.batch_items, use_category_ids=self.use_category_ids)
+
+    @property
+    def use_category_ids(self) -> bool:
+        return self.category_codec is not None and self.category_codec.use_ids
 
     def get_batch_id(self) -> str:
-        # Determine ID key based on domain
-        id_key = "thread_id" if self.config.domain_name == "air" else "ticket_id"
         first_item = self.batch_items[0]
-        return str(first_item.get(id_key, "unknown"))
+        return str(first_item.get(self.config.id_column, "unknown"))
 
     async def call_api(
         self,
@@ -101,12 +267,18 @@ class APIRequest:
         retry_queue: asyncio.Queue,
         save_results: List[Dict[str, Any]],
         status_tracker: StatusTracker,
+        rate_limiter: Optional[RateLimiter] = None,
+        cost_model: Optional[RequestCostModel] = None,
     ):
         batch_id = self.get_batch_id()
         logger.debug(f"[Request #{self.task_id}][Batch {batch_id}] Starting API call")
         
         error = None
+        truncated = False
         try:
+            request_kwargs = {}
+            if self.response_format is not None:
+                request_kwargs["response_format"] = self.response_format
             response = await client.chat.completions.create(
                 model=deployment_name,
                 messages=[
@@ -114,31 +286,51 @@ class APIRequest:
                     {"role": "user", "content": self.user_msg}
                 ],
                 temperature=0.0,
-                max_tokens=1024
+                max_tokens=MAX_OUTPUT_TOKENS,
+                **request_kwargs
             )
 
-            text = response.choices[0].message.content
+            cached_tokens = status_tracker.record_usage(getattr(response, "usage", None))
+            if rate_limiter is not None:
+                rate_limiter.credit_cached_tokens(cached_tokens)
+
+            text = response.choices[0].message.content or ""
             logger.debug(f"[Batch {batch_id}] Response received: {text[:80]}...")
+            truncated = getattr(response.choices[0], "finish_reason", None) == "length"
+            if truncated:
+                status_tracker.num_truncated_responses += 1
+                logger.warning(f"[Batch {batch_id}] Response truncated at max_tokens ({len(self.batch_items)} items)")
 
             try:
-                # Clean up JSON markdown code blocks if present
-                clean_text = text.strip()
-                if clean_text.startswith("```json"):
-                    clean_text = clean_text[7:]
-                if clean_text.endswith("```"):
-                    clean_text = clean_text[:-3]
-                
-                parsed = json.loads(clean_text)
-                
-                if not (isinstance(parsed, list) and len(parsed) == len(self.batch_items)):
-                    logger.warning(f"[Batch {batch_id}] Format Error: Item count mismatch")
-                    raise ValueError("Response format error")
-                self.result = parsed
-                logger.debug(f"[Batch {batch_id}] Successfully processed")
-
-            except json.JSONDecodeError as e:
-                logger.error(f"[Batch {batch_id}] JSON Parse Error: {str(e)}")
+                # 코드 블록/설명 문장이 섞여 있어도 첫 번째 JSON 배열을 찾아 파싱 후 스키마 검증
+                try:
+                    parsed = extract_json_items(text)
+                except ValueError:
+                    if not truncated:
+                        raise
+                    # 잘린 응답: 완성된 항목만 살리고 나머지는 아래에서 빠진 항목으로 재요청
+                    parsed = extract_complete_items(text)
+                parsed, num_invalid = validate_items(parsed, self.config.id_column, self.use_category_ids)
+                if num_invalid:
+                    logger.warning(f"[Batch {batch_id}] Dropped {num_invalid} items not matching RESPONSE_SCHEMA")
+
+                self.result, missing_items, num_unknown = self.reconcile(parsed)
+                if not self.result:
+                    raise ValueError("No valid items in response")
+                if num_unknown:
+                    status_tracker.num_unknown_items += num_unknown
+                    logger.warning(f"[Batch {batch_id}] Dropped {num_unknown} items with unknown IDs")
+                if missing_items:
+                    logger.warning(
+                        f"[Batch {batch_id}] Partial response: {len(self.result)}/{len(self.batch_items)} items"
+                    )
+                else:
+                    logger.debug(f"[Batch {batch_id}] Successfully processed")
+
+            except ValueError as e:
+                logger.error(f"[Batch {batch_id}] Response Parse Error: {str(e)}")
                 logger.debug(f"Raw response: {text}")
+                status_tracker.num_parse_errors += 1
                 error = e
 
         except Exception as e:
@@ -156,25 +348,96 @@ class APIRequest:
 
         if error:
             self.error_msg = str(error)
+            if truncated and len(self.batch_items) > 1 and self.attempts_left > 0 and cost_model is not None:
+                # 살린 항목이 없으면 같은 요청을 다시 보내도 또 잘리므로 배치를 반으로 나눠 재요청
+                # (나뉜 요청도 각각 완료/실패 처리되므로 task 하나를 더 진행 중으로 센다)
+                half = len(self.batch_items) // 2
+                status_tracker.num_tasks_started += 1
+                status_tracker.num_tasks_in_progress += 1
+                status_tracker.num_items_requeued += len(self.batch_items)
+                for items in (self.batch_items[:half], self.batch_items[half:]):
+                    retry_queue.put_nowait(cost_model.build_request(self.task_id, items, self.attempts_left - 1))
+                return
             if self.attempts_left > 0:
                 self.attempts_left -= 1
                 retry_queue.put_nowait(self)
             else:
                 logger.error(f"[Request #{self.task_id}][Batch {batch_id}] Final Failure")
-                # Create fallback empty results
-                id_key = "thread_id" if self.config.domain_name == "air" else "ticket_id"
-                fallback_data = [
-                    {id_key: itm.get(id_key), "level1": None, "level2": None, "level3": None, "error": str(error)}
-                    for itm in self.batch_items
-                ]
-                save_results.extend(fallback_data)
+                save_results.extend(self.fallback_results(self.batch_items, str(error)))
                 status_tracker.num_tasks_failed += 1
                 status_tracker.num_tasks_in_progress -= 1
-        else:
-            save_results.extend(self.result)
+            return
+
+        save_results.extend(self.result)
+        logger.debug(f"[Request #{self.task_id}][Batch {batch_id}] Result saved")
+        if not missing_items:
             status_tracker.num_tasks_succeeded += 1
             status_tracker.num_tasks_in_progress -= 1
-            logger.debug(f"[Request #{self.task_id}][Batch {batch_id}] Result saved")
+        elif self.attempts_left > 0:
+            # 응답에서 빠진 항목만 다시 요청 (같은 task 로 취급하므로 in_progress 유지)
+            status_tracker.num_items_requeued += len(missing_items)
+            if cost_model is not None:
+                retry_request = cost_model.build_request(self.task_id, missing_items, self.attempts_left - 1)
+            else:
+                retry_request = replace(
+                    self, batch_items=missing_items, attempts_left=self.attempts_left - 1, user_msg="", result=[]
+                )
+            retry_queue.put_nowait(retry_request)
+        else:
+            logger.error(f"[Request #{self.task_id}][Batch {batch_id}] {len(missing_items)} items missing after final attempt")
+            save_results.extend(self.fallback_results(missing_items, "Missing from response"))
+            status_tracker.num_tasks_failed += 1
+            status_tracker.num_tasks_in_progress -= 1
+
+    def reconcile(self, parsed: List[Dict[str, Any]]):
+        """
+        응답 항목을 배치의 id 와 대조한다.
+        반환: (채택된 결과, 응답에서 빠진 배치 항목, 배치에 없는 id 로 온 항목 수)
+        - 같은 id 가 여러 번 오면 첫 번째만 채택
+        - ID 모드에서 알 수 없는 category_id 로 온 항목은 빠진 것으로 보고 다시 요청
+        - validate_items 가 응답 id 의 앞뒤 공백을 없애므로 배치 id 도 같은 방식으로 비교하고,
+          채택된 결과에는 병합을 위해 원래 배치 항목의 id 를 넣는다
+        """
+        id_key = self.config.id_column
+        expected = {str(itm.get(id_key)).strip(): itm for itm in self.batch_items}
+        accepted: Dict[str, Dict[str, Any]] = {}
+        num_unknown = 0
+        for item in parsed:
+            item_id = item[id_key]
+            if item_id not in expected:
+                num_unknown += 1
+                continue
+            if item_id in accepted:
+                continue
+            if self.category_codec is not None:
+                item = self.category_codec.decode(item)
+                if item is None:
+                    continue
+            accepted[item_id] = {**item, id_key: expected[item_id].get(id_key)}
+
+        missing_items = [itm for item_id, itm in expected.items() if item_id not in accepted]
+        return list(accepted.values()), missing_items, num_unknown
+
+    def fallback_results(self, items: List[Dict[str, Any]], error_msg: str) -> List[Dict[str, Any]]:
+        """최종 실패한 항목의 빈 결과"""
+        id_key = self.config.id_column
+        return [
+            {id_key: itm.get(id_key), "level1": None, "level2": None, "level3": None, "error": error_msg}
+            for itm in items
+        ]
+
+
+def completed_results(results: List[Dict[str, Any]], id_key: str) -> List[Dict[str, Any]]:
+    """
+    체크포인트 결과 중 완료된 것만 남긴다.
+    - 최종 실패(error) 행은 제외하여 재개 시 다시 요청되게 한다
+    - 같은 id 가 여러 번 기록되어 있으면 마지막 것을 사용
+    """
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for row in results:
+        if not row.get("error"):
+            by_id[str(row.get(id_key))] = row
+    return list(by_id.values())
 
 
 def task_id_generator_function():
@@ -184,7 +447,7 @@ def task_id_generator_function():
         task_id += 1
 
 async def process_api_requests(
-    data_df: pd.DataFrame,
+    data_df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
     config: DomainConfig,
     system_msg: str,
     client: AsyncAzureOpenAI,
@@ -193,137 +456,304 @@ async def process_api_requests(
     max_tokens_per_minute: float = 200000,
     max_attempts: int = 5,
     input_file: str = "",
+    max_in_flight: int = MAX_IN_FLIGHT,
+    min_batch_items: int = MIN_BATCH_ITEMS,
+    max_batch_items: int = MAX_BATCH_ITEMS,
+    target_batch_tokens: int = TARGET_BATCH_INPUT_TOKENS,
+    cached_token_discount: float = CACHED_TOKEN_TPM_DISCOUNT,
+    category_codec: Optional[CategoryCodec] = None,
+    structured_output: bool = False,
+    result_cache: Optional[ResultCache] = None,
+    result_sink: Optional[ResultSink] = None,
+    keep_checkpoint: bool = False,
 ):
     """
     Main async processing loop with checkpoint support.
+    동시에 진행 중인 요청은 max_in_flight 개로 제한되며,
+    중단(Ctrl-C) 시 진행 중인 요청을 취소하고 체크포인트를 저장한다.
+    같은 내용의 항목은 한 번만 요청하고, result_cache 에 있는 항목은 요청하지 않는다.
+    data_df 에 DataFrame 청크 이터레이터를 넘기면 (스트리밍 모드) 다음 청크를 백그라운드 스레드에서
+    읽는 동안 이미 읽은 청크의 요청을 먼저 보낸다.
+    결과는 배치가 끝날 때마다 result_sink 에 쓰고 (같은 내용의 중복 항목 결과도 이때 복제),
+    result_sink 를 넘기지 않으면 모든 결과를 목록으로 반환한다.
+    keep_checkpoint=True 면 완료 후에도 체크포인트를 지우지 않는다 (호출한 쪽이 결과 저장까지 마친 뒤 삭제).
     """
     queue_of_requests_to_retry = asyncio.Queue()
     task_id_generator = task_id_generator_function()
     status_tracker = StatusTracker()
-    next_request = None
-
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
+    rate_limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute, cached_token_discount)
+    cost_model = RequestCostModel(system_msg, config, category_codec, structured_output)
+    # 요청 완료(성공/실패/재시도 등록) 시 set 되어 대기 중인 디스패처를 깨운다
+    task_done_event = asyncio.Event()
+    # 진행 중인 태스크 참조 보관 (GC 방지 및 중단 시 취소용)
+    in_flight_tasks = set()
 
-    # Create batches
-    batches = [
-        data_df.iloc[i : i + BATCH_SIZE].to_dict(orient="records")
-        for i in range(0, len(data_df), BATCH_SIZE)
-    ]
-    logger.info(f"Created {len(batches)} batches from {len(data_df)} items.")
+    id_key = config.id_column
+    sink = result_sink if result_sink is not None else MemoryResultSink()
+    chunk_iter = iter([data_df] if isinstance(data_df, pd.DataFrame) else data_df)
+    loop = asyncio.get_running_loop()
 
-    # 체크포인트 관리자 초기화
+    # 체크포인트에서 복구 (저널 재생): 배치 경계와 무관하게 완료된 항목 id 기준으로 건너뛴다
     checkpoint_mgr = CheckpointManager(input_file, config.domain_name) if input_file else None
 
-    all_results = []
-    batch_idx = 0
-    batches_exhausted = False
-    last_checkpoint_batch = 0
+    # 청크 간에 이어지는 상태
+    representatives: Dict[str, str] = {}  # 내용 키 -> 대표 항목 id
+    duplicate_ids: Dict[str, List[Any]] = {}
+    cache_keys_by_id: Dict[str, str] = {}
+    # 결과를 쓸 때 함께 복제한 중복 항목 수 (중복 항목이 있는 대표 항목만, 결과 행 자체는 보관하지 않음)
+    num_fanned_out: Dict[str, int] = {}
+    num_results = 0  # sink 에 쓴 결과 행 수 (중복 항목 복제 포함)
 
-    # 체크포인트에서 복구
+    def emit(rows: List[Dict[str, Any]]):
+        """결과를 sink 에 쓴다. 지금까지 발견된 같은 내용의 중복 항목에도 결과를 복제한다"""
+        nonlocal num_results
+        for row in rows:
+            rep_id = str(row.get(id_key))
+            if rep_id in duplicate_ids:
+                num_fanned_out[rep_id] = len(duplicate_ids[rep_id])
+        expanded = fan_out_results(rows, duplicate_ids, id_key)
+        sink.write(expanded)
+        num_results += len(expanded)
+
+    def emit_late_duplicates():
+        """
+        결과를 쓴 뒤에 발견된 중복 항목(이후 청크나 체크포인트 복구 뒤에 발견)의 결과를 쓴다.
+        모든 요청이 끝난 뒤 호출하며, 대표 항목 결과는 sink 에 이미 쓴 행에서 다시 찾는다.
+        """
+        nonlocal num_results
+        late_ids = {
+            rep_id: dup_ids[num_fanned_out.get(rep_id, 0):]
+            for rep_id, dup_ids in duplicate_ids.items()
+            if len(dup_ids) > num_fanned_out.get(rep_id, 0)
+        }
+        if not late_ids:
+            return
+        rows = []
+        for rep_id, row in sink.find_rows(set(late_ids), id_key).items():
+            rows.extend({**row, id_key: dup_id} for dup_id in late_ids[rep_id])
+            num_fanned_out[rep_id] = len(duplicate_ids[rep_id])
+        sink.write(rows)
+        num_results += len(rows)
+
+    def cache_results(rows: Iterable[Dict[str, Any]]):
+        """성공한 결과만 캐시에 저장 (id 는 실행마다 다르므로 제외)"""
+        if result_cache is None:
+            return
+        result_cache.put_many({
+            cache_keys_by_id[str(row.get(id_key))]: {k: v for k, v in row.items() if k != id_key}
+            for row in rows
+            if not row.get("error") and str(row.get(id_key)) in cache_keys_by_id
+        })
+
+    done_ids: Set[str] = set()
+    # 체크포인트에서 복구된 결과 중 아직 캐시에 저장하지 않은 것 (캐시 키는 해당 항목을 읽을 때 계산됨)
+    restored_to_cache: Dict[str, Dict[str, Any]] = {}
     if checkpoint_mgr and checkpoint_mgr.exists():
         checkpoint_data = checkpoint_mgr.load()
         if checkpoint_data:
-            all_results = checkpoint_data.get("results", [])
-            batch_idx = checkpoint_data.get("processed_batch_idx", 0)
-            last_checkpoint_batch = batch_idx
-            logger.info(f"Resuming from checkpoint: {batch_idx}/{len(batches)} batches ({len(all_results)} items already processed)")
-            if batch_idx >= len(batches):
-                batches_exhausted = True
-    
+            restored_results = completed_results(checkpoint_data.get("results", []), id_key)
+            # 실패 행/중복 행을 걸러낸 결과로 저널을 정리 (재개할 때마다 커지지 않도록)
+            checkpoint_mgr.compact(restored_results)
+            done_ids = {str(row.get(id_key)) for row in restored_results}
+            if result_cache is not None:
+                restored_to_cache = {str(row.get(id_key)): row for row in restored_results}
+            emit(restored_results)
+            logger.info(f"Resuming from checkpoint: {len(restored_results)} items already processed")
+
+    def prepare_items(chunk_df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """청크에서 실제로 요청할 항목만 남긴다 (중복 제거 → 체크포인트 → 결과 캐시 순)"""
+        items = chunk_df.to_dict(orient="records")
+
+        # 같은 내용의 항목은 대표 항목 하나만 요청하고 결과를 복제
+        items, _ = collapse_duplicates(items, id_key, representatives, duplicate_ids)
+
+        # 결과 캐시 키 (체크포인트에서 복구된 결과도 완료 시 캐시에 저장되도록 체크포인트 필터 전에 계산)
+        if result_cache is not None:
+            cache_keys_by_id.update((str(item.get(id_key)), result_cache.key_for(item)) for item in items)
+
+        if done_ids:
+            # 체크포인트에서 복구된 결과도 캐시에 저장 (캐시 키가 정해진 지금 저장하고 보관한 행은 버린다)
+            if restored_to_cache:
+                cache_results([
+                    restored_to_cache.pop(str(item.get(id_key)))
+                    for item in items if str(item.get(id_key)) in restored_to_cache
+                ])
+            items = [item for item in items if str(item.get(id_key)) not in done_ids]
+
+        # 결과 캐시 조회 (적중한 항목은 요청하지 않음)
+        if result_cache is not None:
+            cache_hits = result_cache.get_many(cache_keys_by_id[str(item.get(id_key))] for item in items)
+            remaining_items = []
+            cached_results = []
+            for item in items:
+                cached = cache_hits.get(cache_keys_by_id[str(item.get(id_key))])
+                if cached is None:
+                    remaining_items.append(item)
+                else:
+                    cached_results.append({id_key: item.get(id_key), **cached})
+            emit(cached_results)
+            items = remaining_items
+        return items
+
+    def plan(items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        # 토큰 예산 기반 가변 크기 배치
+        return list(plan_batches(
+            items,
+            min_items=min_batch_items,
+            max_items=max_batch_items,
+            target_input_tokens=target_batch_tokens,
+        ))
+
+    pending_batches: Deque[List[Dict[str, Any]]] = deque()
+    # 청크 마지막의 덜 찬 배치는 다음 청크 항목과 합쳐서 다시 구성한다
+    carry: List[Dict[str, Any]] = []
+    next_chunk = None  # 백그라운드에서 읽는 중인 다음 청크 (버퍼 1청크)
+    source_exhausted = False
+    num_items = 0
+    num_batches = 0
+
+    def fetch_next_chunk():
+        return loop.run_in_executor(None, next, chunk_iter, None)
+
+    async def refill_batches():
+        """보낼 배치가 없으면 다음 청크를 받아 배치를 구성한다"""
+        nonlocal carry, next_chunk, source_exhausted, num_items, num_batches
+        while not pending_batches and not source_exhausted:
+            if next_chunk is None:
+                next_chunk = fetch_next_chunk()
+            chunk_df = await next_chunk
+            next_chunk = None
+
+            if chunk_df is None:
+                source_exhausted = True
+                batches = plan(carry)
+                carry = []
+            else:
+                # 이번 청크를 배치로 나누는 동안 다음 청크를 미리 읽는다
+                next_chunk = fetch_next_chunk()
+                items = prepare_items(chunk_df)
+                num_items += len(items)
+                batches = plan(carry + items)
+                carry = batches.pop() if batches else []
+
+            num_batches += len(batches)
+            pending_batches.extend(batches)
+
+        if source_exhausted:
+            # 입력을 모두 읽은 시점에 한 번만 요약 로그
+            num_duplicates = sum(len(ids) for ids in duplicate_ids.values())
+            if num_duplicates:
+                logger.info(f"Collapsed {num_duplicates} duplicate items into {len(duplicate_ids)} unique requests.")
+            if result_cache is not None:
+                result_cache.log_stats()
+            avg_batch_size = num_items / num_batches if num_batches else 0
+            logger.info(f"Created {num_batches} batches from {num_items} items (avg {avg_batch_size:.1f} items/batch).")
+
+    batch_idx = 0
+
+    async def run_request(request: APIRequest):
+        try:
+            request_results = []
+            await request.call_api(
+                client=client,
+                deployment_name=deployment_name,
+                retry_queue=queue_of_requests_to_retry,
+                save_results=request_results,
+                status_tracker=status_tracker,
+                rate_limiter=rate_limiter,
+                cost_model=cost_model
+            )
+            emit(request_results)
+            cache_results(request_results)
+            # 완료된 결과만 저널에 추가 (파일 쓰기는 writer 스레드에서)
+            if checkpoint_mgr:
+                checkpoint_mgr.submit(request_results)
+        finally:
+            # done callback 이 아닌 여기서 제거해야 깨어난 디스패처가 최신 상태를 본다
+            in_flight_tasks.discard(asyncio.current_task())
+            task_done_event.set()
+
     logger.debug("Entering main loop")
-    
-    while True:
-        # Get next request
-        if next_request is None:
+
+    try:
+        while True:
+            # clear 이후 상태를 확인하므로 그 사이에 완료된 요청을 놓치지 않는다
+            task_done_event.clear()
+
+            # 동시 요청 수가 한도에 도달하면 하나가 끝날 때까지 대기 (backpressure)
+            if len(in_flight_tasks) >= max_in_flight:
+                await task_done_event.wait()
+                continue
+
+            # Get next request
+            next_request = None
             if not queue_of_requests_to_retry.empty():
                 next_request = queue_of_requests_to_retry.get_nowait()
                 logger.debug(f"Retrying request {next_request.task_id}")
-            elif not batches_exhausted and batch_idx < len(batches):
-                current_batch = batches[batch_idx]
-                batch_idx += 1
-                if batch_idx >= len(batches):
-                    batches_exhausted = True
-                
-                # We need to approximate token count for rate limiting
-                # We use the config's user msg creator to measure size
-                user_msg_dummy = config.user_message_creator(current_batch)
-                token_count = count_tokens(system_msg) + count_tokens(user_msg_dummy) + (100 * len(current_batch))
-                
-                next_request = APIRequest(
-                    task_id=next(task_id_generator),
-                    batch_items=current_batch,
-                    token_consumption=token_count,
-                    attempts_left=max_attempts,
-                    system_msg=system_msg,
-                    config=config
-                )
-                status_tracker.num_tasks_started += 1
-                status_tracker.num_tasks_in_progress += 1
-                
-                if batch_idx % CHUNK_LOG == 0 or batch_idx == len(batches):
-                    logger.info(f"Progress: {batch_idx}/{len(batches)} batches queued")
-                    status_tracker.log_status()
-
-                # 체크포인트 저장 (CHECKPOINT_INTERVAL 배치마다)
-                if checkpoint_mgr and (batch_idx - last_checkpoint_batch) >= CHECKPOINT_INTERVAL:
-                    # 비동기 작업 완료 대기
-                    await asyncio.sleep(1.0)
-                    # 실제 완료된 결과 수 기준으로 저장 (안전한 복구를 위해)
-                    completed_batches = len(all_results) // BATCH_SIZE
-                    checkpoint_mgr.save(all_results.copy(), completed_batches, len(batches))
-                    last_checkpoint_batch = batch_idx
-                    
-        # Update Rate Limits
-        current_time = time.time()
-        seconds_since_update = current_time - last_update_time
-        available_request_capacity = min(
-            available_request_capacity + max_requests_per_minute * seconds_since_update / 60.0,
-            max_requests_per_minute,
-        )
-        available_token_capacity = min(
-            available_token_capacity + max_tokens_per_minute * seconds_since_update / 60.0,
-            max_tokens_per_minute,
-        )
-        last_update_time = current_time
-        
-        # Issue Request if valid
-        if next_request:
-            if (available_request_capacity >= 1 and 
-                available_token_capacity >= next_request.token_consumption):
-                
-                available_request_capacity -= 1
-                available_token_capacity -= next_request.token_consumption
-                
-                asyncio.create_task(
-                    next_request.call_api(
-                        client=client,
-                        deployment_name=deployment_name,
-                        retry_queue=queue_of_requests_to_retry,
-                        save_results=all_results,
-                        status_tracker=status_tracker
-                    )
-                )
-                next_request = None
-        
-        if status_tracker.num_tasks_in_progress == 0 and batches_exhausted and queue_of_requests_to_retry.empty():
-            break
-            
-        await asyncio.sleep(SECONDS_TO_SLEEP_EACH_LOOP)
-        
-        # Cool down if rate limited
-        seconds_since_rate_limit = time.time() - status_tracker.time_of_last_rate_limit_error
-        if (seconds_since_rate_limit < SECONDS_TO_PAUSE_AFTER_RATE_LIMIT 
-            and status_tracker.time_of_last_rate_limit_error > 0):
-            wait_time = SECONDS_TO_PAUSE_AFTER_RATE_LIMIT - seconds_since_rate_limit
-            logger.warning(f"Rate limit cooldown: waiting {wait_time:.1f}s")
-            await asyncio.sleep(wait_time)
-            
-    logger.info(f"Processing complete. Generated {len(all_results)} results.")
-
-    # 완료 시 체크포인트 삭제
-    if checkpoint_mgr:
-        checkpoint_mgr.cleanup()
-
-    return all_results
+            else:
+                if not pending_batches and not source_exhausted:
+                    await refill_batches()
+                if pending_batches:
+                    current_batch = pending_batches.popleft()
+                    batch_idx += 1
+
+                    # Rate limit 용 토큰 추정과 요청 생성 (user message 는 한 번만 렌더링)
+                    next_request = cost_model.build_request(next(task_id_generator), current_batch, max_attempts)
+                    status_tracker.num_tasks_started += 1
+                    status_tracker.num_tasks_in_progress += 1
+
+                    all_queued = source_exhausted and not pending_batches
+                    if batch_idx % CHUNK_LOG == 0 or all_queued:
+                        total = f"/{num_batches}" if source_exhausted else ""
+                        logger.info(f"Progress: {batch_idx}{total} batches queued")
+                        status_tracker.log_status()
+
+            if next_request is None:
+                if status_tracker.num_tasks_in_progress == 0:
+                    break
+                # 보낼 요청이 없으면 진행 중인 요청이 끝나거나 재시도가 등록될 때까지 대기
+                await task_done_event.wait()
+                continue
+
+            # Cool down if rate limited
+            seconds_since_rate_limit = time.time() - status_tracker.time_of_last_rate_limit_error
+            if (seconds_since_rate_limit < SECONDS_TO_PAUSE_AFTER_RATE_LIMIT
+                and status_tracker.time_of_last_rate_limit_error > 0):
+                wait_time = SECONDS_TO_PAUSE_AFTER_RATE_LIMIT - seconds_since_rate_limit
+                logger.warning(f"Rate limit cooldown: waiting {wait_time:.1f}s")
+                await asyncio.sleep(wait_time)
+
+            # RPM/TPM 용량이 확보될 때까지 필요한 시간만큼만 대기
+            await rate_limiter.acquire(next_request.token_consumption)
+            in_flight_tasks.add(asyncio.create_task(run_request(next_request)))
+
+        emit_late_duplicates()
+        logger.info(f"Processing complete. Generated {num_results} results.")
+        status_tracker.log_status()
+
+        # 완료 시 체크포인트 삭제 (keep_checkpoint 이면 닫기만 한다)
+        if checkpoint_mgr:
+            if keep_checkpoint:
+                checkpoint_mgr.close()
+            else:
+                checkpoint_mgr.cleanup()
+            checkpoint_mgr = None
+    except BaseException as e:
+        # 중단(Ctrl-C/취소)뿐 아니라 입력 파싱 오류, SQLite 오류 등으로 끝날 때도 진행 중인 요청을 정리
+        if isinstance(e, (asyncio.CancelledError, KeyboardInterrupt)):
+            logger.warning(f"Interrupted: cancelling {len(in_flight_tasks)} in-flight requests")
+        else:
+            logger.error(f"Processing failed ({e!r}): cancelling {len(in_flight_tasks)} in-flight requests")
+        for task in list(in_flight_tasks):
+            task.cancel()
+        if next_chunk is not None:
+            next_chunk.cancel()
+        await asyncio.gather(*in_flight_tasks, return_exceptions=True)
+        raise
+    finally:
+        if checkpoint_mgr:
+            # 완료된 배치는 이미 저널에 있으므로 남은 쓰기만 마무리 (다음 실행에서 이어서 처리)
+            checkpoint_mgr.close()
+            logger.info(f"Checkpoint saved: {checkpoint_mgr.checkpoint_path} ({num_results} items)")
+
+    return sink.rows if result_sink is None else None
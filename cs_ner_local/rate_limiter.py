@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    요청 수(RPM)와 토큰 수(TPM)를 함께 관리하는 비동기 토큰 버킷.
+    용량이 부족하면 다시 채워질 때까지 필요한 시간만큼만 대기한다 (busy-poll 없음).
+    """
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float,
+                 cached_token_discount: float = 0.0):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        # prompt cache 로 처리된 토큰 중 TPM 용량으로 되돌려 줄 비율 (0 = 차감 그대로 유지)
+        self.cached_token_discount = cached_token_discount
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        current_time = time.monotonic()
+        seconds_since_update = current_time - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * seconds_since_update / 60.0,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * seconds_since_update / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = current_time
+
+    def _seconds_until_available(self, tokens: float) -> float:
+        """요청 1건과 tokens 만큼의 용량이 확보될 때까지 남은 시간(초)"""
+        request_deficit = 1 - self.available_request_capacity
+        token_deficit = tokens - self.available_token_capacity
+        wait_for_requests = max(0.0, request_deficit * 60.0 / self.max_requests_per_minute)
+        wait_for_tokens = max(0.0, token_deficit * 60.0 / self.max_tokens_per_minute)
+        return max(wait_for_requests, wait_for_tokens)
+
+    async def acquire(self, tokens: float):
+        """용량이 확보될 때까지 대기한 뒤 요청 1건과 tokens 만큼을 차감"""
+        # 버킷 최대치보다 큰 요청은 영원히 대기하게 되므로 최대치로 제한
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                wait_time = self._seconds_until_available(tokens)
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+            self.available_request_capacity -= 1
+            self.available_token_capacity -= tokens
+
+    def credit_cached_tokens(self, cached_tokens: int):
+        """prompt cache 로 처리된 토큰만큼 (discount 비율로) TPM 용량을 되돌려 준다"""
+        if cached_tokens <= 0 or self.cached_token_discount <= 0:
+            return
+        self._refill()
+        self.available_token_capacity = min(
+            self.available_token_capacity + cached_tokens * self.cached_token_discount,
+            self.max_tokens_per_minute,
+        )
@@ -0,0 +1,116 @@
+import json
+from typing import List, Dict, Any, Tuple
+
+from categories import LEVEL_FIELDS
+
+# Structured output 은 최상위가 object 여야 하므로 배열을 이 키로 감싼다
+RESULTS_KEY = "results"
+
+_decoder = json.JSONDecoder()
+
+
+def response_fields(use_category_ids: bool) -> Tuple[str, ...]:
+    """id 컬럼 외에 응답 항목에 있어야 하는 필드"""
+    return ("category_id",) if use_category_ids else LEVEL_FIELDS
+
+
+def build_response_format(id_column: str, use_category_ids: bool = False) -> Dict[str, Any]:
+    """
+    RESPONSE_SCHEMA (create_user_message_air / create_user_message_simple) 와 같은 구조의
+    JSON-schema structured output 설정.
+    """
+    fields = (id_column,) + response_fields(use_category_ids)
+    item_schema = {
+        "type": "object",
+        "properties": {key: {"type": "string"} for key in fields},
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "classification_results",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {RESULTS_KEY: {"type": "array", "items": item_schema}},
+                "required": [RESULTS_KEY],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _as_items(parsed: Any):
+    if isinstance(parsed, list):
+        return parsed
+    if isinstance(parsed, dict) and isinstance(parsed.get(RESULTS_KEY), list):
+        return parsed[RESULTS_KEY]
+    return None
+
+
+def extract_json_items(text: str) -> List[Any]:
+    """
+    응답 텍스트에서 결과 배열을 꺼낸다.
+    - 순수 JSON (배열 또는 {"results": [...]}) 이면 그대로 파싱
+    - ```json 코드 블록이나 앞뒤 설명 문장이 섞여 있으면 object 를 담은 첫 번째 JSON 배열
+      (또는 {"results": [...]}) 을 찾는다. 설명 문장 속 "[2]" 같은 배열은 건너뛴다
+    """
+    text = (text or "").strip()
+    try:
+        items = _as_items(json.loads(text))
+        if items is not None:
+            return items
+    except json.JSONDecodeError:
+        pass
+
+    for idx, char in enumerate(text):
+        if char not in "[{":
+            continue
+        try:
+            parsed, _ = _decoder.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict) and isinstance(parsed.get(RESULTS_KEY), list):
+            return parsed[RESULTS_KEY]
+        if isinstance(parsed, list) and any(isinstance(item, dict) for item in parsed):
+            return parsed
+    raise ValueError("No JSON array found in response")
+
+
+def extract_complete_items(text: str) -> List[Dict[str, Any]]:
+    """
+    max_tokens 에서 잘린 응답 (finish_reason == "length") 에서 끝까지 완성된 항목 object 만 꺼낸다.
+    결과 배열이 닫히지 않아 extract_json_items 로는 파싱되지 않을 때 사용한다.
+    """
+    text = text or ""
+    items = []
+    idx = text.find("{")
+    while idx != -1:
+        try:
+            parsed, end = _decoder.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            # {"results": [ 처럼 닫히지 않은 바깥 object 는 건너뛰고 안쪽 항목부터 다시 찾는다
+            idx = text.find("{", idx + 1)
+            continue
+        if isinstance(parsed, dict) and RESULTS_KEY not in parsed:
+            items.append(parsed)
+        idx = text.find("{", end)
+    return items
+
+
+def validate_items(items: List[Any], id_column: str, use_category_ids: bool = False) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    스키마에 맞는 항목만 남긴다 (id 컬럼과 응답 필드가 모두 문자열로 있어야 함).
+    추가 필드는 제거한다. 반환: (유효 항목, 버려진 항목 수)
+    """
+    fields = (id_column,) + response_fields(use_category_ids)
+    valid = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        values = {key: item.get(key) for key in fields}
+        if any(value is None or isinstance(value, (dict, list)) for value in values.values()):
+            continue
+        valid.append({key: str(value).strip() for key, value in values.items()})
+    return valid, len(items) - len(valid)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+from batch_planner import PROMPT_FIELDS
+from utils import logger
+
+DEFAULT_MAX_ENTRIES = 500_000
+SQLITE_MAX_VARIABLES = 900  # IN (...) 절 한 번에 넣을 키 개수
+
+
+def content_key(item: Dict[str, Any]) -> str:
+    """API 로 전송되는 필드(마스킹된 content + pre_level 힌트) 기준 해시. 같은 키면 같은 요청 내용."""
+    payload = "\x1f".join("" if item.get(key) is None else str(item.get(key)) for key in PROMPT_FIELDS)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def collapse_duplicates(
+    items: List[Dict[str, Any]],
+    id_key: str,
+    representatives: Optional[Dict[str, str]] = None,
+    duplicate_ids: Optional[Dict[str, List[Any]]] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, List[Any]]]:
+    """
+    같은 내용의 항목을 하나로 합친다.
+    반환: (대표 항목 목록, 대표 항목 id -> 같은 내용인 다른 항목 id 목록)
+    청크 단위로 나눠 호출할 때는 representatives(내용 키 -> 대표 항목 id)/duplicate_ids 를 넘겨 상태를 이어간다.
+    """
+    if representatives is None:
+        representatives = {}
+    if duplicate_ids is None:
+        duplicate_ids = {}
+    unique_items = []
+    for item in items:
+        key = content_key(item)
+        item_id = str(item.get(id_key))
+        rep_id = representatives.get(key)
+        if rep_id is None:
+            representatives[key] = item_id
+            unique_items.append(item)
+        elif item_id != rep_id:
+            duplicate_ids.setdefault(rep_id, []).append(item.get(id_key))
+    return unique_items, duplicate_ids
+
+
+def fan_out_results(results: List[Dict[str, Any]], duplicate_ids: Dict[str, List[Any]], id_key: str) -> List[Dict[str, Any]]:
+    """대표 항목의 결과를 같은 내용의 다른 항목 id 로 복제"""
+    if not duplicate_ids:
+        return results
+    expanded = list(results)
+    for row in results:
+        for dup_id in duplicate_ids.get(str(row.get(id_key)), ()):
+            expanded.append({**row, id_key: dup_id})
+    return expanded
+
+
+class ResultCache:
+    """
+    분류 결과 영구 캐시 (SQLite).
+    키 = hash(문의 내용 키 + 실행 컨텍스트)
+    실행 컨텍스트 = 프롬프트 버전 + 배포명 + 시스템 프롬프트(카테고리 테이블 포함) 해시.
+    카테고리/프롬프트/모델이 바뀌면 키가 달라지므로 이전 결과는 자연스럽게 쓰이지 않고, 오래된 순으로 삭제된다.
+    """
+
+    def __init__(self, path: str, context: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_used ON results(last_used)")
+        self.conn.commit()
+
+    def key_for(self, item: Dict[str, Any]) -> str:
+        return hashlib.sha256(f"{self.context_hash}:{content_key(item)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """캐시에 있는 키의 결과만 반환 (hit/miss 집계, 사용 시각 갱신)"""
+        keys = list(keys)
+        found: Dict[str, Dict[str, Any]] = {}
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, result FROM results WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            found.update((key, json.loads(result)) for key, result in rows)
+
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE results SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries: Dict[str, Dict[str, Any]]):
+        if not entries:
+            return
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO results (key, result, last_used) VALUES (?, ?, ?)",
+            [(key, json.dumps(result, ensure_ascii=False), now) for key, result in entries.items()],
+        )
+        self.conn.commit()
+
+    def evict(self) -> int:
+        """max_entries 를 넘는 항목을 오래 사용되지 않은 순으로 삭제"""
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        self.conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self.conn.commit()
+        return excess
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        logger.info(f"Result cache: {self.hits} hits, {self.misses} misses ({ratio:.1%} hit rate)")
+
+    def close(self):
+        evicted = self.evict()
+        if evicted:
+            logger.info(f"Result cache: evicted {evicted} old entries")
+        self.conn.close()
@@ -0,0 +1,154 @@
+import csv
+import json
+import os
+from typing import List, Dict, Any, Set
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+
+from utils import logger
+
+# API 결과 행의 컬럼 (id 컬럼 + 아래 필드)
+RESULT_FIELDS = ("level1", "level2", "level3", "error")
+
+
+class ResultSink:
+    """
+    API 결과 행을 배치 단위로 받는 출력 대상.
+    process_api_requests 는 배치가 끝날 때마다 write() 를 호출한다.
+    """
+
+    def write(self, rows: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def find_rows(self, ids: Set[str], id_column: str) -> Dict[str, Dict[str, Any]]:
+        """이미 쓴 결과 중 id 가 ids 에 있는 행 (나중에 발견된 중복 항목에 결과를 복제할 때 사용)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryResultSink(ResultSink):
+    """결과를 메모리 목록에 모은다 (파일 출력 없이 결과 목록이 필요할 때)"""
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+
+    def write(self, rows: List[Dict[str, Any]]):
+        self.rows.extend(rows)
+
+    def find_rows(self, ids: Set[str], id_column: str) -> Dict[str, Dict[str, Any]]:
+        return {str(row.get(id_column)): row for row in self.rows if str(row.get(id_column)) in ids}
+
+
+class CsvResultSink(ResultSink):
+    """결과 행을 CSV 에 추가 (배치마다 flush 하므로 실행 중에도 열어볼 수 있음)"""
+
+    def __init__(self, path: str, id_column: str):
+        self.path = path
+        self._file = open(path, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.DictWriter(
+            self._file, fieldnames=[id_column, *RESULT_FIELDS], restval="", extrasaction="ignore"
+        )
+        self._writer.writeheader()
+        self._file.flush()
+
+    def write(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def find_rows(self, ids: Set[str], id_column: str) -> Dict[str, Dict[str, Any]]:
+        self._file.flush()
+        with open(self.path, newline="", encoding="utf-8-sig") as f:
+            return {row[id_column]: row for row in csv.DictReader(f) if row[id_column] in ids}
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlResultSink(ResultSink):
+    """결과 행을 JSON Lines 로 추가 (한 줄에 한 행)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        self._file.flush()
+
+    def find_rows(self, ids: Set[str], id_column: str) -> Dict[str, Dict[str, Any]]:
+        self._file.flush()
+        found = {}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if str(row.get(id_column)) in ids:
+                    found[str(row.get(id_column))] = row
+        return found
+
+    def close(self):
+        self._file.close()
+
+
+def open_result_sink(path: str, id_column: str) -> ResultSink:
+    """확장자로 형식 선택 (.jsonl 이면 JSON Lines, 그 외 CSV)"""
+    if path.endswith(".jsonl"):
+        return JsonlResultSink(path)
+    return CsvResultSink(path, id_column)
+
+
+def read_results(path: str, id_column: str) -> pd.DataFrame:
+    """sink 가 쓴 결과 파일을 읽는다 (id 는 문자열, 모두 비어 있는 error 컬럼은 제외)"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return pd.DataFrame()
+    if path.endswith(".jsonl"):
+        df = pd.read_json(path, lines=True, dtype={id_column: str})
+    else:
+        # 카테고리 명칭이 "NA" 등이어도 결측값으로 바뀌지 않도록 빈 칸만 결측값으로 읽는다
+        df = pd.read_csv(path, dtype={id_column: str}, encoding="utf-8-sig", keep_default_na=False, na_values=[""])
+    if "error" in df.columns and df["error"].isna().all():
+        df = df.drop(columns=["error"])
+    logger.info(f"Read {len(df)} result rows from {path}")
+    return df
+
+
+def merge_results(original_df: pd.DataFrame, results_df: pd.DataFrame, id_column: str) -> pd.DataFrame:
+    """
+    원본 행 기준 LEFT JOIN (행 수/순서 유지). pd.merge(how="left") 와 같은 결과 컬럼을 원본에 바로 붙인다.
+    - 결과에 같은 id 가 여러 번 있으면 마지막 행을 사용 (원본 행이 늘어나지 않음)
+    - 원본 id 는 factorize 한 뒤 고유값만 문자열로 바꿔 결과 위치를 찾는다
+      (Air 는 thread 결과 하나가 같은 thread 의 모든 ticket 행에 복제됨)
+    """
+    result_ids = results_df[id_column].astype(str)
+    duplicated = result_ids.duplicated(keep="last")
+    num_duplicated = int(duplicated.sum())
+    if num_duplicated:
+        logger.warning(f"{num_duplicated} result rows had a duplicate {id_column}; keeping the last one")
+        results_df = results_df[~duplicated.to_numpy()]
+        result_ids = result_ids[~duplicated]
+
+    # 원본 행 → 고유 id 코드 (결측 id 는 -1) → 결과 행 위치 (없으면 -1)
+    codes, unique_ids = pd.factorize(original_df[id_column])
+    unique_positions = pd.Index(result_ids.to_numpy()).get_indexer(pd.Index(unique_ids).astype(str))
+    row_positions = np.where(codes >= 0, unique_positions[codes], -1)
+
+    matched = int((row_positions >= 0).sum())
+    logger.info(f"Matched results for {matched}/{len(original_df)} rows")
+
+    for col in results_df.columns:
+        if col == id_column:
+            continue
+        values = take(results_df[col].to_numpy(), row_positions, allow_fill=True)
+        if col in original_df.columns:
+            # pd.merge 와 같은 suffix 규칙
+            original_df = original_df.rename(columns={col: f"{col}_x"})
+            col = f"{col}_y"
+        original_df[col] = values
+    return original_df
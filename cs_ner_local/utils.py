@@ -3,6 +3,8 @@ import logging
 import time
 from dataclasses import dataclass
 import os
+from functools import lru_cache
+from typing import List, Sequence
 
 # Logger configuration
 def setup_logging(level=logging.INFO):
@@ -16,13 +18,32 @@ def setup_logging(level=logging.INFO):
 logger = setup_logging()
 
 # Tokenizer setup (optional tiktoken)
-# _tiktoken_encoding = None
-# try:
-#     import tiktoken
-#     _tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
-#     logger.debug("tiktoken 사용: 정확한 토큰 카운팅")
-# except ImportError:
-#     logger.debug("tiktoken 미설치: 문자 수 기반 추정 사용")
+# 모듈 import 시점이 아니라 최초 count_tokens 호출 시 한 번만 로드한다 (.env 로드 이후).
+# - TIKTOKEN_ENCODING: 인코딩 이름 (gpt-4.1 / gpt-4o 계열은 o200k_base)
+# - TIKTOKEN_CACHE_DIR: 인코딩 파일을 미리 받아둔 폴더 (오프라인/사내망 환경, tiktoken 표준 설정)
+DEFAULT_TIKTOKEN_ENCODING = "o200k_base"
+TOKEN_COUNT_CACHE_SIZE = 4096
+_tiktoken_encoding = None
+_tiktoken_load_attempted = False
+
+
+def _get_tiktoken_encoding():
+    global _tiktoken_encoding, _tiktoken_load_attempted
+    if _tiktoken_load_attempted:
+        return _tiktoken_encoding
+    _tiktoken_load_attempted = True
+
+    encoding_name = os.getenv("TIKTOKEN_ENCODING", DEFAULT_TIKTOKEN_ENCODING)
+    try:
+        import tiktoken
+        _tiktoken_encoding = tiktoken.get_encoding(encoding_name)
+        logger.info(f"tiktoken 사용: {encoding_name} 인코딩으로 정확한 토큰 카운팅")
+    except ImportError:
+        logger.info("tiktoken 미설치: 문자 수 기반 추정 사용")
+    except Exception as e:
+        # 오프라인 환경에서 인코딩 파일을 받지 못한 경우 등
+        logger.warning(f"tiktoken 인코딩 로드 실패 ({encoding_name}): {e} - 문자 수 기반 추정 사용")
+    return _tiktoken_encoding
 
 @dataclass
 class StatusTracker:
@@ -33,23 +54,67 @@ class StatusTracker:
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0
     num_other_errors: int = 0
+    num_parse_errors: int = 0
+    num_truncated_responses: int = 0
+    num_unknown_items: int = 0
+    num_items_requeued: int = 0
     time_of_last_rate_limit_error: float = 0
+    num_prompt_tokens: int = 0
+    num_cached_prompt_tokens: int = 0
+    num_completion_tokens: int = 0
+
+    def record_usage(self, usage) -> int:
+        """응답의 usage 를 누적하고, 그 중 prompt cache 에서 처리된 토큰 수를 반환"""
+        if usage is None:
+            return 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+        self.num_prompt_tokens += getattr(usage, "prompt_tokens", None) or 0
+        self.num_completion_tokens += getattr(usage, "completion_tokens", None) or 0
+        self.num_cached_prompt_tokens += cached_tokens
+        return cached_tokens
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        if self.num_prompt_tokens == 0:
+            return 0.0
+        return self.num_cached_prompt_tokens / self.num_prompt_tokens
 
     def log_status(self):
         logger.info(
             f"Status: {self.num_tasks_succeeded} success, {self.num_tasks_failed} failed, "
-            f"{self.num_tasks_in_progress} pending, {self.num_rate_limit_errors} rate limits"
+            f"{self.num_tasks_in_progress} pending, {self.num_rate_limit_errors} rate limits, "
+            f"{self.num_parse_errors} parse errors, {self.num_truncated_responses} truncated, "
+            f"{self.num_items_requeued} items requeued, "
+            f"prompt cache {self.cache_hit_ratio:.1%} ({self.num_cached_prompt_tokens}/{self.num_prompt_tokens} tokens)"
         )
 
+def _estimate_tokens(text: str) -> int:
+    # Fallback: 문자 수 / 2 (한국어 보수적 추정)
+    return max(1, len(text) // 2)
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
 def count_tokens(text: str) -> int:
     """
     Returns the number of tokens in a text string.
     tiktoken 설치 시 정확한 값, 미설치 시 문자 수 기반 추정.
     (한국어 기준 보수적으로 2자 = 1토큰으로 계산)
+    시스템 프롬프트처럼 반복되는 문자열은 LRU 캐시에서 바로 반환된다.
     """
+    encoding = _get_tiktoken_encoding()
+    if encoding is not None:
+        # encode()는 본문에 <|endoftext|> 같은 특수 토큰 문자열이 있으면 예외를 내므로 encode_ordinary 사용
+        return len(encoding.encode_ordinary(text))
+    return _estimate_tokens(text)
 
-    _tiktoken_encoding = None
-    if _tiktoken_encoding is not None:
-        return len(_tiktoken_encoding.encode(text))
-    # Fallback: 문자 수 / 2 (한국어 보수적 추정)
-    return max(1, len(text) // 2)
+
+def count_tokens_many(texts: Sequence[str]) -> List[int]:
+    """
+    여러 문자열의 토큰 수를 한 번에 계산 (tiktoken 배치 인코딩 사용).
+    문의 본문처럼 대부분 한 번만 등장하는 문자열용이므로 캐시를 거치지 않는다.
+    """
+    encoding = _get_tiktoken_encoding()
+    if encoding is not None:
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(list(texts))]
+    return [_estimate_tokens(text) for text in texts]